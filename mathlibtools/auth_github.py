@@ -1,19 +1,28 @@
+from functools import lru_cache
+from typing import Optional
 from git import Repo, InvalidGitRepositoryError # type: ignore
 from github import Github # type: ignore
 import configparser
 
+@lru_cache(maxsize=8)
+def _github(login_or_token: Optional[str] = None,
+            password: Optional[str] = None) -> Github:
+    """Build a Github object, reusing it (and its HTTP connections) for
+    identical credentials."""
+    return Github(login_or_token, password, per_page=100)
+
 def auth_github(repo: Repo) -> Github:
     config = repo.config_reader()
     try:
-        return Github(config.get('github', 'user'), config.get('github', 'password'))
+        return _github(config.get('github', 'user'), config.get('github', 'password'))
     except configparser.NoSectionError:
         print('Info: No github section found in \'git config\', we will use GitHub with no authentication')
-        return Github()
+        return _github()
     except configparser.NoOptionError:
         try:
-            return Github(config.get('github', 'oauthtoken'))
+            return _github(config.get('github', 'oauthtoken'))
         except configparser.NoOptionError:
             print("Info: No github 'user'/'password' or 'oauthtoken' keys found in git config, "
                   "we will use GitHub with no authentication.")
             print('You can create an OAuth token at https://github.com/settings/tokens/new (no scopes are required).')
-            return Github()
+            return _github()
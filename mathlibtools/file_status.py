@@ -1,9 +1,61 @@
+import hashlib
+import pickle
 import re
-from dataclasses import asdict, dataclass
-from typing import Any, Dict, Optional, Union
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple, Union
 
 import requests
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader, SafeDumper # type: ignore
+
+# Parses a port status message in a single match: the lookahead finds the
+# mathlib4 PR number anywhere in the message, then the status prefix and,
+# for ported files, the mathlib3 hash which is the third word.
+MESSAGE_RE = re.compile(r"(?=(?:.*?mathlib4#(?P<pr>[0-9]+))?)"
+                        r"(?:(?P<yes>Yes)(?:\S*\s+\S+\s+(?P<hash>\S+))?|(?P<no>No))?",
+                        re.DOTALL)
+
+PORT_STATUS_URL = "https://raw.githubusercontent.com/wiki/leanprover-community/mathlib/mathlib4-port-status.md"
+
+
+def cache_key(url: str) -> str:
+    """The name under which data from url is cached."""
+    return hashlib.sha1(url.encode()).hexdigest()
+
+def cached_get(url: str, cache_dir: Optional[Path] = None) -> bytes:
+    """
+    Download the content at url. If cache_dir is given, the content is kept
+    there along with its ETag and Last-Modified date, and is only downloaded
+    again if it changed.
+    """
+    if cache_dir is None:
+        return requests.get(url).content
+    key = cache_key(url)
+    content_path = cache_dir/(key + '.yaml')
+    validators = [('ETag', 'If-None-Match', cache_dir/(key + '.etag')),
+                  ('Last-Modified', 'If-Modified-Since', cache_dir/(key + '.modified'))]
+    headers = {}
+    if content_path.exists():
+        for _, request_header, path in validators:
+            if path.exists():
+                headers[request_header] = path.read_text()
+    resp = requests.get(url, headers=headers)
+    if resp.status_code == 304:
+        return content_path.read_bytes()
+    values = [resp.headers.get(response_header) for response_header, _, _ in validators]
+    if resp.status_code == 200 and any(values):
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        content_path.write_bytes(resp.content)
+        for (_, _, path), value in zip(validators, values):
+            if value:
+                path.write_text(value)
+            elif path.exists():
+                path.unlink()
+    return resp.content
 
 
 @dataclass()
@@ -16,21 +68,16 @@ class FileStatus:
 
     @classmethod
     def parse_old(cls, message: str) -> "FileStatus":
-        ported = False
-        mathlib4_pr: Optional[int] = None
-        mathlib3_hash: Optional[str] = None
+        m = MESSAGE_RE.match(message)
+        assert m  # every group is optional
+        ported = m.group("yes") is not None
+        mathlib4_pr = int(m.group("pr")) if m.group("pr") else None
+        mathlib3_hash: Optional[str] = m.group("hash")
         comments = None
-        if message.startswith("Yes"):
-            ported = True
-            parts = message.split(None, 3)
-            if len(parts) > 2:
-                mathlib3_hash = parts[2]
-        elif message.startswith("No"):
+        if m.group("no"):
             comments = message[2:].lstrip(': ')
-        else:
+        elif not ported:
             comments = message.lstrip()
-        if "mathlib4#" in message:
-            mathlib4_pr = int(re.findall(r"[0-9]+", message.replace("mathlib4#", ""))[0])
         return cls(
             ported=ported,
             mathlib4_pr=mathlib4_pr,
@@ -39,7 +86,9 @@ class FileStatus:
         )
 
     def asdict(self) -> Dict[str, Any]:
-        return {k: v for k, v in asdict(self).items() if v is not None}
+        # all fields are plain values, no need for the deep copy done by
+        # dataclasses.asdict
+        return {k: v for k, v in vars(self).items() if v is not None}
 
     @property
     def pr_link(self) -> Optional[str]:
@@ -59,20 +108,44 @@ class PortStatus:
 
     file_statuses: Dict[str, FileStatus]
 
-    @classmethod
-    def old_yaml(cls, url: Optional[str] = None) -> Dict[str, str]:
-        if url is None:
-            url = "https://raw.githubusercontent.com/wiki/leanprover-community/mathlib/mathlib4-port-status.md"
-        def yaml_md_load(wikicontent: bytes):
-            return yaml.safe_load(wikicontent.replace(b"```", b""))
+    @staticmethod
+    def yaml_md_load(wikicontent: bytes) -> Dict[str, str]:
+        return yaml.load(wikicontent.replace(b"```", b""), Loader=SafeLoader)
 
-        return yaml_md_load(requests.get(url).content)
+    @classmethod
+    def old_yaml(cls, url: Optional[str] = None,
+                 cache_dir: Optional[Path] = None) -> Dict[str, str]:
+        return cls.yaml_md_load(cached_get(url or PORT_STATUS_URL, cache_dir))
 
     @classmethod
-    def deserialize_old(cls, yaml: Optional[Dict[str, str]] = None) -> "PortStatus":
-        if yaml is None:
-            yaml = cls.old_yaml()
-        return cls(file_statuses={k: FileStatus.parse_old(v) for k, v in yaml.items()})
+    def deserialize_old(cls, yaml: Optional[Dict[str, str]] = None,
+                        cache_dir: Optional[Path] = None,
+                        url: Optional[str] = None) -> "PortStatus":
+        """
+        Parse the port status, downloaded from url (by default the wiki) if
+        yaml is not given. If cache_dir is given, the parsed status is also
+        kept there, and reused as long as the downloaded content is the same.
+        """
+        if yaml is not None:
+            return cls(file_statuses={k: FileStatus.parse_old(v) for k, v in yaml.items()})
+        url = url or PORT_STATUS_URL
+        content = cached_get(url, cache_dir)
+        if cache_dir is None:
+            return cls.deserialize_old(cls.yaml_md_load(content))
+        digest = hashlib.sha1(content).digest()
+        pickle_path = cache_dir/(cache_key(url) + '.pickle')
+        try:
+            cached: Tuple[bytes, PortStatus] = pickle.loads(pickle_path.read_bytes())
+            if cached[0] == digest:
+                return cached[1]
+        except Exception:
+            # missing, or written by another version
+            pass
+        status = cls.deserialize_old(cls.yaml_md_load(content))
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        pickle_path.write_bytes(pickle.dumps((digest, status)))
+        return status
 
     def serialize(self) -> Dict[str, Dict[str, Union[int, str, None]]]:
-        return yaml.dump({k: v.asdict() for k, v in self.file_statuses.items()})
+        return yaml.dump({k: v.asdict() for k, v in self.file_statuses.items()},
+                         Dumper=SafeDumper)
@@ -1,5 +1,5 @@
 from git import Commit   # type: ignore
-from typing import Callable, Iterator, Tuple, List
+from typing import Callable, Dict, Iterator, Tuple, List
 
 
 def short_sha(rev: Commit) -> str:
@@ -55,24 +55,33 @@ def visit_ancestors(rev: Commit) -> Iterator[Tuple[Commit, Callable]]:
     and ``G``, it will always be pruned before it is visited.
     """
     repo = rev.repo
-    pruned_commits : List[Commit] = []  # the commits to ignore along with their ancestors
-    skip_n = 0  # the index to resume the iteration
-    while True:
-        args = [rev] + ['--not'] + pruned_commits
-        proc = repo.git.rev_list(*args, as_process=True, skip=skip_n, topo_order=True)
-        for c in Commit._iter_from_process_or_stream(repo, proc):
-            # build a temporary function to hand back to the user
-            do_prune = False
-            def prune():
-                nonlocal do_prune
-                do_prune = True
-            yield c, prune
-            if do_prune:
-                pruned_commits.append(c)
-                break
-            else:
-                # start after this commit next time we restart the search
-                skip_n += 1
-        else:
-            # all ancestors found
-            return
+    # Read the whole commit graph with a single `git rev-list` call, pruning
+    # then happens in-process instead of restarting `git rev-list`.
+    parents: Dict[str, List[str]] = {}
+    for line in repo.git.rev_list(rev.hexsha, parents=True).splitlines():
+        sha, *parent_shas = line.split()
+        parents[sha] = parent_shas
+    # the number of children of each commit which were not visited yet
+    nb_children = dict.fromkeys(parents, 0)
+    for parent_shas in parents.values():
+        for p in parent_shas:
+            nb_children[p] += 1
+
+    # As in `git rev-list --topo-order`, a commit is pushed on the stack once
+    # all its children have been visited. The parents of a pruned commit are
+    # never pushed, hence none of its ancestors are visited.
+    todo = [rev.hexsha]
+    while todo:
+        sha = todo.pop()
+        # build a temporary function to hand back to the user
+        do_prune = False
+        def prune():
+            nonlocal do_prune
+            do_prune = True
+        yield Commit(repo, bytes.fromhex(sha)), prune
+        if do_prune:
+            continue
+        for p in parents[sha]:
+            nb_children[p] -= 1
+            if nb_children[p] == 0:
+                todo.append(p)
@@ -1,34 +1,158 @@
-import copy
+from collections import OrderedDict
+from functools import wraps
 from pathlib import Path
-from typing import Optional
-import tempfile
+from typing import Any, Callable, Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple
 import subprocess
 
 from mathlibtools.file_status import FileStatus
 
 import networkx as nx # type: ignore
 
+# tactic files which are kept by `ImportGraph.exclude_tactics`
+KEPT_TACTICS = {'tactic.basic', 'tactic.core'}
+
+# key of the transitive reduction flag in `ImportGraph._cache`
+_REDUCED = ('is_reduced', '')
+
+# number of ancestor and descendant sets memoized by each graph
+_REACHABLE_CACHE_SIZE = 256
+
+# marks missing attributes in `ImportGraph.to_gexf`
+_MISSING = object()
+
+def _dot_quote(value: Any) -> str:
+    """Quotes a node name or attribute value for the dot language."""
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def _dot_attrs(attrs: Dict[str, Any]) -> str:
+    """Formats an attribute list for the dot language, skipping unset values."""
+    items = ', '.join(f'{k}={_dot_quote(v)}' for k, v in attrs.items()
+                      if v is not None)
+    return f' [{items}]' if items else ''
+
+def _reachable(adj: Dict[str, Dict[str, Any]], node: str) -> Set[str]:
+    """The nodes other than node reachable from it following the adjacency
+    dict adj (such as `DiGraph._succ`), like `nx.descendants` but without
+    its generic BFS machinery."""
+    if node not in adj:
+        raise nx.NetworkXError(f"The node {node} is not in the digraph.")
+    seen = {node}
+    todo = [node]
+    while todo:
+        for other in adj[todo.pop()]:
+            if other not in seen:
+                seen.add(other)
+                todo.append(other)
+    seen.discard(node)
+    return seen
+
+def _clears_cache(method: Callable) -> Callable:
+    """Wraps a graph mutation so that it clears the graph's cached queries."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._cache.clear()
+        return method(self, *args, **kwargs)
+    return wrapper
+
+def _memoized(method: Callable) -> Callable:
+    """Caches the results of a graph method until the graph changes. The same
+    graph is then returned to every caller, which should not modify it."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__, repr((args, sorted(kwargs.items()))))
+        if key not in self._cache:
+            self._cache[key] = method(self, *args, **kwargs)
+        return self._cache[key]
+    return wrapper
+
 class ImportGraph(nx.DiGraph):
     def __init__(self, base_path: Optional[Path] = None) -> None:
         """A Lean project import graph."""
+        # results of graph queries, cleared on every mutation
+        self._cache: Dict[Tuple[str, str], Any] = {}
         super().__init__(self)
         self.base_path = base_path or Path('.')
 
+    add_node = _clears_cache(nx.DiGraph.add_node)
+    add_nodes_from = _clears_cache(nx.DiGraph.add_nodes_from)
+    remove_node = _clears_cache(nx.DiGraph.remove_node)
+    remove_nodes_from = _clears_cache(nx.DiGraph.remove_nodes_from)
+    add_edge = _clears_cache(nx.DiGraph.add_edge)
+    add_edges_from = _clears_cache(nx.DiGraph.add_edges_from)
+    remove_edge = _clears_cache(nx.DiGraph.remove_edge)
+    remove_edges_from = _clears_cache(nx.DiGraph.remove_edges_from)
+    clear = _clears_cache(nx.DiGraph.clear)
+    clear_edges = _clears_cache(nx.DiGraph.clear_edges)
+
+    def _memoized_reachable(self, direction: str, adj: Dict[str, Dict[str, Any]],
+                            node: str) -> FrozenSet[str]:
+        """The nodes reachable from node following adj, memoized until the
+        graph changes for the _REACHABLE_CACHE_SIZE most recent nodes."""
+        recent = self._cache.setdefault(('reachable', direction), OrderedDict())
+        if node in recent:
+            recent.move_to_end(node)
+            return recent[node]
+        result = recent[node] = frozenset(_reachable(adj, node))
+        if len(recent) > _REACHABLE_CACHE_SIZE:
+            recent.popitem(last=False)
+        return result
+
+    def _ancestors(self, node: str) -> FrozenSet[str]:
+        """The nodes leading to node."""
+        return self._memoized_reachable('ancestors', self._pred, node)
+
+    def _descendants(self, node: str) -> FrozenSet[str]:
+        """The nodes descending from node."""
+        return self._memoized_reachable('descendants', self._succ, node)
+
+    def _indexed(self) -> Tuple[List[str], Dict[str, int], List[List[int]], List[List[int]]]:
+        """The nodes in topological order, their indices in this order, and
+        the successors and predecessors of each of them as such indices."""
+        key = ('indexed', '')
+        if key not in self._cache:
+            order = list(nx.topological_sort(self))
+            index = {n: i for i, n in enumerate(order)}
+            succ = [[index[c] for c in self._succ[n]] for n in order]
+            pred = [[index[p] for p in self._pred[n]] for n in order]
+            self._cache[key] = (order, index, succ, pred)
+        return self._cache[key]
+
+    def _dot_lines(self) -> Iterator[str]:
+        """The lines of a graphviz dot description of itself (without layout)."""
+        yield 'strict digraph {\n'
+        for n, attrs in self.nodes(data=True):
+            yield f'{_dot_quote(n)}{_dot_attrs(attrs)};\n'
+        for u, v, attrs in self.edges(data=True):
+            yield f'{_dot_quote(u)} -> {_dot_quote(v)}{_dot_attrs(attrs)};\n'
+        yield '}\n'
+
+    def _run_dot(self, dot_format: str, path: Path) -> None:
+        """Lays itself out with graphviz into path, in the given output format.
+        Raises `subprocess.CalledProcessError`, with graphviz's error output,
+        if graphviz fails."""
+        subprocess.run(['dot', '-T' + dot_format, '-o', str(path)],
+                       input=''.join(self._dot_lines()), stderr=subprocess.PIPE,
+                       universal_newlines=True, check=True)
+
     def to_dot(self, path: Optional[Path] = None) -> None:
         """Writes itself to a graphviz dot file."""
         path = path or self.base_path/'import_graph.dot'
-        nx.drawing.nx_pydot.to_pydot(self).write_dot(str(path))
+        self._run_dot('dot', path)
 
     def to_rawdot(self, path: Optional[Path] = None) -> None:
         """Writes itself to a raw dot file (without layout)."""
         path = path or self.base_path/'import_graph.rawdot'
-        nx.drawing.nx_pydot.write_dot(self, str(path))
+        with path.open('w') as outf:
+            outf.writelines(self._dot_lines())
 
     def to_gexf(self, path: Optional[Path] = None) -> None:
         """Writes itself to a gexf dot file, suitable for Gephi."""
         path = path or self.base_path/'import_graph.gexf'
-        modified = copy.deepcopy(self)
-        for _, attrs in modified.nodes(data=True):
+        # Temporarily replace the attributes gexf cannot store, rather than
+        # writing a deep copy of the graph.
+        saved = []
+        for _, attrs in self.nodes(data=True):
+            saved.append((attrs, attrs.get("status"), attrs.get("fillcolor", _MISSING)))
             status: Optional[FileStatus] = attrs.get("status")
             if status is None:
                 attrs["status"] = ""
@@ -36,7 +160,16 @@ class ImportGraph(nx.DiGraph):
                 attrs["status"] = status.to_gexf()
             if "fillcolor" in attrs and attrs["fillcolor"] is None:
                 attrs.pop("fillcolor")
-        nx.write_gexf(modified, str(path))
+        try:
+            nx.write_gexf(self, str(path))
+        finally:
+            for attrs, status, fillcolor in saved:
+                if status is None:
+                    attrs.pop("status")
+                else:
+                    attrs["status"] = status
+                if fillcolor is not _MISSING:
+                    attrs["fillcolor"] = fillcolor
 
     def to_graphml(self, path: Optional[Path] = None) -> None:
         """Writes itself to a gexf dot file, suitable for yEd."""
@@ -53,71 +186,157 @@ class ImportGraph(nx.DiGraph):
         elif path.suffix == '.graphml':
             self.to_graphml(path)
         elif path.suffix in ['.pdf', '.svg', '.png']:
-            dot_format = '-T' + path.suffix[1:]
-            with tempfile.TemporaryDirectory() as tmpdirname:
-                tmpf = Path(tmpdirname)/'tmp.dot'
-                self.to_dot(tmpf)
-                with path.open('w') as outf:
-                    subprocess.run(['dot', dot_format, str(tmpf)],
-                                   stdout=outf)
+            self._run_dot(path.suffix[1:], path)
         else:
             raise ValueError('Unsupported graph output format. '
                              'Use .dot, .rawdot, .gexf, .graphml or a valid '
                              'graphviz output format (eg. .pdf).')
 
+    def _subgraph(self, nodes: Iterable[str]) -> 'ImportGraph':
+        """Returns a new graph induced on nodes, rather than a subgraph view
+        which would filter every later access through this graph."""
+        nodes = set(nodes)
+        H = ImportGraph(self.base_path)
+        H.add_nodes_from((n, attrs) for n, attrs in self._node.items() if n in nodes)
+        H.add_edges_from((u, v, attrs) for u in H for v, attrs in self._succ[u].items()
+                         if v in nodes)
+        # removing nodes cannot create new paths, so reduced graphs stay reduced
+        if self.is_reduced:
+            H._cache[_REDUCED] = True
+        return H
+
+    @property
+    def is_reduced(self) -> bool:
+        """Whether this graph is known to be transitively reduced, which is
+        forgotten as soon as it changes."""
+        return self._cache.get(_REDUCED, False)
+
     def ancestors(self, node: str) -> 'ImportGraph':
         """Returns the subgraph leading to node."""
-        H = self.subgraph(nx.ancestors(self, node).union([node]))
-        H.base_path = self.base_path
+        H = self._subgraph(self._ancestors(node).union([node]))
         return H
 
     def descendants(self, node: str) -> 'ImportGraph':
         """Returns the subgraph descending from node."""
-        H = self.subgraph(nx.descendants(self, node).union([node]))
-        H.base_path = self.base_path
+        H = self._subgraph(self._descendants(node).union([node]))
         return H
 
     def big_component(self) -> 'ImportGraph':
-        H = self.subgraph(max(nx.weakly_connected_components(self), key=len))
-        H.base_path = self.base_path
+        component: Set[str] = max(nx.weakly_connected_components(self), key=len)
+        H = self._subgraph(component)
         return H
 
     def path(self, start: str, end: str) -> 'ImportGraph':
         """Returns the subgraph descending from the start node and used by the
         end node."""
-        D = self.descendants(start)
-        A = self.ancestors(end)
-        H = self.subgraph(set(D.nodes).intersection(A.nodes))
-        H.base_path = self.base_path
+        order, index, succ, pred = self._indexed()
+        for n in (start, end):
+            if n not in index:
+                raise nx.NetworkXError(f"The node {n} is not in the digraph.")
+        first, last = index[start], index[end]
+        if last < first:
+            # end comes before start in topological order, so it cannot
+            # descend from it
+            return ImportGraph(self.base_path)
+        # Both walks share a single buffer over the node indices: 1 marks the
+        # descendants of start, 2 those of them which also lead to end. Nodes
+        # after end in topological order cannot lead to it, so they are skipped.
+        mark = bytearray(last + 1)
+        mark[first] = 1
+        todo = [first]
+        while todo:
+            for j in succ[todo.pop()]:
+                if j <= last and not mark[j]:
+                    mark[j] = 1
+                    todo.append(j)
+        nodes = []
+        i = last
+        if mark[i]:
+            mark[i] = 2
+            todo = [i]
+            while todo:
+                for j in pred[todo.pop()]:
+                    if mark[j] == 1:
+                        mark[j] = 2
+                        todo.append(j)
+            nodes = [order[i] for i, m in enumerate(mark) if m == 2]
+        H = self._subgraph(nodes)
         return H
 
-    def exclude_tactics(self) -> 'ImportGraph':
+    @_memoized
+    def exclude_tactics(self, reduce: bool = False) -> 'ImportGraph':
         """Removes all files in src/tactic/ and src/meta/ from the graph,
-        except tactic.basic and tactic.core (but adds extra edges to reflect transitive dependencies)."""
-        H = self
-        to_delete = [n for n in H.nodes if
-            n != 'tactic.basic' and n != 'tactic.core' and str.startswith(n, ('tactic.', 'meta.'))]
-        for n in to_delete:
-            parents = [k for (k, _) in H.in_edges([n])]
-            children = [m for (_, m) in H.out_edges([n])]
-            for k in parents:
-                for m in children:
-                    H.add_edge(k, m)
-            H.remove_node(n)
-        H.base_path = self.base_path
+        except tactic.basic and tactic.core (but adds extra edges to reflect transitive dependencies).
+        With reduce, the result is also transitively reduced, without building
+        the intermediate graph."""
+        def excluded(n: str) -> bool:
+            return n not in KEPT_TACTICS and n.startswith(('tactic.', 'meta.'))
+
+        H = ImportGraph(self.base_path)
+        H.add_nodes_from((n, attrs) for n, attrs in self.nodes(data=True)
+                         if not excluded(n))
+        # For each excluded file, the closest kept files it depends on, through
+        # excluded files only. In a single topological sweep, each kept file
+        # is linked once to those of its imports.
+        # When reducing, the reflexive ancestors of kept files are stored as
+        # bitsets, as in `transitive_reduction` but walking the other way.
+        order, index, _, _ = self._indexed()
+        sources: Dict[str, Set[str]] = {}
+        ancestors: Dict[str, int] = {}
+        edges = []
+        for n in order:
+            imports = set()
+            for p in self.predecessors(n):
+                if p in sources:
+                    imports.update(sources[p])
+                else:
+                    imports.add(p)
+            if excluded(n):
+                sources[n] = imports
+            elif reduce:
+                row = 1 << index[n]
+                for p in sorted(imports, key=index.__getitem__, reverse=True):
+                    if not row >> index[p] & 1:
+                        row |= ancestors[p]
+                        edges.append((p, n))
+                ancestors[n] = row
+            else:
+                edges.extend((p, n) for p in imports)
+        H.add_edges_from(edges)
+        if reduce:
+            H._cache[_REDUCED] = True
         return H
 
+    @_memoized
     def transitive_reduction(self) -> 'ImportGraph':
         """Removes all imports that are in the transitive closure of other imports."""
-        H = self.edge_subgraph(nx.transitive_reduction(self).edges())
-        H.base_path = self.base_path
+        if self.is_reduced:
+            return self
+        # The reflexive transitive closure is stored as the rows of a boolean
+        # matrix, using python integers as bitsets indexed by the topological
+        # order. As in graphviz's tred, the imports of a file are visited in
+        # topological order, so an import is redundant iff it is reachable
+        # through the imports kept before it, and only those are merged.
+        order, _, succ, _ = self._indexed()
+        closure = [0] * len(order)
+        edges = []
+        for i in reversed(range(len(order))):
+            row = 1 << i
+            for j in sorted(succ[i]):
+                if not row >> j & 1:
+                    row |= closure[j]
+                    edges.append((order[i], order[j]))
+            closure[i] = row
+        H = ImportGraph(self.base_path)
+        H.add_nodes_from(self.nodes(data=True))
+        H.add_edges_from(edges)
+        H._cache[_REDUCED] = True
         return H
 
     def delete_ported(self) -> 'ImportGraph':
         """Delete all nodes marked as ported during port_status"""
-        H = self.subgraph({node for node, attrs in self.nodes(data=True)
-                          if not (attrs.get("status") and attrs.get("status").ported)})
-        H.base_path = self.base_path
+        H = self._subgraph({node for node, attrs in self.nodes(data=True)
+                           if not (attrs.get("status") and attrs.get("status").ported)})
         return H
 
     def delete_ported_children(self, exclude_tactics: bool) -> 'ImportGraph':
@@ -128,32 +347,55 @@ class ImportGraph(nx.DiGraph):
             to_remove = set()
         finished_nodes = {node for node, attrs in self.nodes(data=True)
                           if attrs.get("status").ported}
-        for node in finished_nodes:
-            children = {child for _, child in self.out_edges(node)}
-            if children.issubset(finished_nodes):
-                to_remove.add(node)
-        H = self.subgraph(self.nodes - to_remove)
-        H.base_path = self.base_path
+        to_remove.update(node for node in finished_nodes
+                         if all(child in finished_nodes for child in self._succ[node]))
+        H = self._subgraph(self.nodes - to_remove)
         return H
 
     def completely_ported(self) -> 'ImportGraph':
         """Retain only nodes marked as ported, and all of whose descendants are marked as ported."""
-        unported = {node for node, attrs in self.nodes(data=True)
-                    if not (attrs.get("status") and attrs.get("status").ported)}
-        unported.discard("all")
-        keeping = set(self.nodes)
-        keeping.discard("all")
-        for n in unported:
-            keeping = keeping.difference(nx.ancestors(self, n))
-            keeping.discard(n)
-        H = self.subgraph(keeping)
+        # In a single sweep in reverse topological order, a node is dropped if
+        # it is unported or leads to a dropped node.
+        order, _, succ, _ = self._indexed()
+        dropped = bytearray(len(order))
+        for i in reversed(range(len(order))):
+            status = self.nodes[order[i]].get("status")
+            if (order[i] != "all" and not (status and status.ported)) or \
+                    any(dropped[j] for j in succ[i]):
+                dropped[i] = 1
+        H = self._subgraph(n for n, d in zip(order, dropped) if not d and n != "all")
         return H
 
     def size(self) -> 'int':
         return nx.number_of_nodes(self)
 
     def longest_path_length(self) -> 'int':
-        return nx.dag_longest_path_length(self)
+        return max(len(self._longest_path()) - 1, 0)
+
+    def longest_path(self) -> List[str]:
+        """A longest chain of imports, chosen as `nx.dag_longest_path` does."""
+        return list(self._longest_path())
 
-    def longest_path(self):
-        return nx.dag_longest_path(self)
+    def _longest_path(self) -> Tuple[str, ...]:
+        """The longest path, computed once for both the path and its length."""
+        key = ('longest_path', '')
+        if key in self._cache:
+            return self._cache[key]
+        order, _, _, pred = self._indexed()
+        # length of the longest path ending at each node, and its previous node
+        dist = [0] * len(order)
+        prev = list(range(len(order)))
+        for i, ps in enumerate(pred):
+            for j in ps:
+                if dist[j] + 1 > dist[i] or prev[i] == i:
+                    dist[i] = dist[j] + 1
+                    prev[i] = j
+        path = []
+        if order:
+            i = max(range(len(order)), key=dist.__getitem__)
+            path.append(i)
+            while prev[i] != i:
+                i = prev[i]
+                path.append(i)
+        self._cache[key] = tuple(order[i] for i in reversed(path))
+        return self._cache[key]
@@ -1,20 +1,37 @@
 import sys
+import re
+from bisect import bisect_left
+from dataclasses import dataclass
+import subprocess
 from pathlib import Path
 from datetime import datetime
-from typing import List, Tuple, Optional
+from functools import lru_cache
+from typing import List, Tuple, Optional, TYPE_CHECKING
 from getpass import getpass
-
-from git.exc import GitCommandError # type: ignore
+import logging
 
 import click
 
-from mathlibtools.lib import (LeanProject, log,
-    InvalidLeanProject, LeanDownloadError, set_download_url, touch_oleans,
-    CacheFallback)
+from mathlibtools import __version__
+
+# Importing mathlibtools.lib pulls in GitPython, requests and yaml,
+# so commands import it when they run, which keeps `leanproject --help` fast.
+if TYPE_CHECKING:
+    from mathlibtools.lib import LeanProject
+
+# the logger configured by mathlibtools.lib
+log = logging.getLogger("Mathlib tools")
 
 # Click aliases from Stephen Rauch at
 # https://stackoverflow.com/questions/46641928
 class CustomMultiCommand(click.Group):
+    # sorted command names for prefix lookups, reset when commands are added
+    _sorted_commands: Optional[List[str]] = None
+
+    def add_command(self, cmd, name=None):
+        super().add_command(cmd, name)
+        self._sorted_commands = None
+
     def command(self, *args, **kwargs):
         """Behaves the same as `click.Group.command()` except if passed
         a list of names, all after the first will be aliases for the first.
@@ -40,23 +57,45 @@ class CustomMultiCommand(click.Group):
         rv = click.Group.get_command(self, ctx, cmd_name)
         if rv is not None:
             return rv
-        matches = [x for x in self.list_commands(ctx)
-                   if x.startswith(cmd_name)]
+        if self._sorted_commands is None:
+            self._sorted_commands = self.list_commands(ctx)
+        names = self._sorted_commands
+        matches = []
+        for i in range(bisect_left(names, cmd_name), len(names)):
+            if not names[i].startswith(cmd_name):
+                break
+            matches.append(names[i])
         if not matches:
             return None
         elif len(matches) == 1:
             return click.Group.get_command(self, ctx, matches[0])
         ctx.fail('Too many matches: %s' % ', '.join(sorted(matches)))
 
-def proj() -> LeanProject:
-    return LeanProject.from_path(Path('.'), cache_url, force_download,
-                                 lean_upgrade)
-
-# The following are global state variables. This is a lazy way of propagating
-# the global options.
-cache_url = ''
-force_download = False
-lean_upgrade = True
+def proj() -> 'LeanProject':
+    """The project in the current directory, built only once per invocation
+    since this runs git and reads leanpkg.toml."""
+    from mathlibtools.lib import LeanProject
+    ctx = click.get_current_context()
+    opts: CliOpts = ctx.obj
+    # ctx.meta is shared by all contexts of an invocation, and only lives as
+    # long as it does
+    projects = ctx.meta.setdefault('mathlibtools.projects', {})
+    path = Path('.').resolve()
+    if path not in projects:
+        projects[path] = LeanProject.from_path(path, opts.cache_url,
+                                               opts.force_download,
+                                               opts.lean_upgrade)
+    return projects[path]
+
+@dataclass(frozen=True)
+class CliOpts:
+    """Global options, stored as the click context object."""
+    cache_url: str = ''
+    force_download: bool = False
+    lean_upgrade: bool = True
+    debug: bool = False
+
+# debug is also needed by safe_cli, after the context is gone.
 debug = False
 
 def handle_exception(exc, msg):
@@ -75,24 +114,26 @@ def handle_exception(exc, msg):
               help='Do not upgrade Lean version when upgrading mathlib.')
 @click.option('--debug', 'python_debug', default=False, is_flag=True,
               help='Display python tracebacks in case of error.')
-@click.version_option()
-def cli(from_url: str, force: bool, noleanup: bool, python_debug: bool) -> None:
+@click.version_option(__version__, prog_name='leanproject')
+@click.pass_context
+def cli(ctx: click.Context, from_url: str, force: bool, noleanup: bool,
+        python_debug: bool) -> None:
     """Command line client to manage Lean projects depending on mathlib.
     Use leanproject COMMAND --help to get more help on any specific command."""
-    global cache_url, force_download, lean_upgrade, debug
-    cache_url = from_url
-    force_download = force
-    lean_upgrade = not noleanup
+    global debug
+    ctx.obj = CliOpts(from_url, force, not noleanup, python_debug)
     debug = python_debug
 
 @cli.command()
 @click.argument('path', default='.')
-def new(path: str = '.') -> None:
+@click.pass_obj
+def new(opts: CliOpts, path: str = '.') -> None:
     """Create a new Lean project and prepare mathlib.
 
     If no directory name is given, the current directory is used.
     """
-    LeanProject.new(Path(path), cache_url, force_download)
+    from mathlibtools.lib import LeanProject
+    LeanProject.new(Path(path), opts.cache_url, opts.force_download)
 
 @cli.command()
 def add_mathlib() -> None:
@@ -100,14 +141,16 @@ def add_mathlib() -> None:
     proj().add_mathlib()
 
 @cli.command(['upgrade-mathlib', 'update-mathlib', 'up'])
-def upgrade_mathlib() -> None:
+@click.pass_obj
+def upgrade_mathlib(opts: CliOpts) -> None:
     """Upgrade mathlib (as a dependency or as the main project)."""
+    from mathlibtools.lib import LeanProject, LeanDownloadError, InvalidLeanProject
     try:
         proj().upgrade_mathlib()
     except LeanDownloadError as err:
         handle_exception(err, 'Failed to fetch mathlib oleans')
     except InvalidLeanProject:
-        project = LeanProject.user_wide(cache_url, force_download)
+        project = LeanProject.user_wide(opts.cache_url, opts.force_download)
         project.upgrade_mathlib()
 
 @cli.command()
@@ -115,6 +158,14 @@ def build() -> None:
     """Build the current project."""
     proj().build()
 
+# A project name is either a git url or a GitHub name with an optional
+# organization, and may end with ':branch'
+PROJECT_NAME_RE = re.compile(r"""
+    (?: (?P<url> (?:https?://|git@[^:]*:) [^:]* )
+      | (?: (?P<org> [^/:]* ) / )? (?P<name> [^/:]* ) )
+    (?: : (?P<branch> [^:]* ) )?""", re.VERBOSE)
+
+@lru_cache(maxsize=64)
 def parse_project_name(name: str, ssh: bool = True) -> Tuple[str, str, str, bool]:
     """Parse the name argument for get_project
     Returns (name, url, branch, is_url).
@@ -123,32 +174,22 @@ def parse_project_name(name: str, ssh: bool = True) -> Tuple[str, str, str, bool
     """
     # This is split off the actual command function for
     # unit testing purposes
-    if ':' in name:
-        pieces = name.split(':')
-        if len(pieces) >= 3:
-            name = ':'.join(pieces[:-1])
-            branch = pieces[-1]
-        elif 'http' in pieces[0] or '@' in pieces[0]:
-            branch = ''
-        else:
-            name, branch = pieces
+    match = PROJECT_NAME_RE.fullmatch(name)
+    if not match:
+        raise click.BadParameter('Invalid project name: ' + name)
+    url, org, name, branch = match.group('url', 'org', 'name', 'branch')
+    branch = branch or ''
+
+    if url:
+        name = url.rpartition('/')[2].replace('.git', '')
+        is_url = True
     else:
-        branch = ''
-
-    if not name.startswith(('git@', 'http')):
-        if '/' not in name:
-            org_name = 'leanprover-community/'+name
-        else:
-            org_name, name = name, name.split('/')[1]
+        org_name = (org or 'leanprover-community') + '/' + name
         if ssh:
             url = 'git@github.com:'+org_name+'.git'
         else:
             url = 'https://github.com/'+org_name+'.git'
         is_url = False
-    else:
-        url = name
-        name = name.split('/')[-1].replace('.git', '')
-        is_url = True
 
     return name, url, branch, is_url
 
@@ -157,7 +198,14 @@ def parse_project_name(name: str, ssh: bool = True) -> Tuple[str, str, str, bool
 @click.argument('directory', default='')
 @click.option('--new-branch', '-b', default=False, is_flag=True,
               help='Create a new branch.')
-def get_project(name: str, new_branch: bool, directory: str = '') -> None:
+@click.option('--depth', default=0, type=click.IntRange(min=0),
+              help='Only clone the last DEPTH commits (default: 0, the whole history).')
+@click.option('--partial/--no-partial', default=False,
+              help='Clone the whole history but only download the files of '
+                   'commits which are checked out.')
+@click.pass_obj
+def get_project(opts: CliOpts, name: str, new_branch: bool,
+                directory: str = '', depth: int = 0, partial: bool = False) -> None:
     """Clone a project from a GitHub name or git url.
 
     Put it in dir if this argument is given.
@@ -167,26 +215,45 @@ def get_project(name: str, new_branch: bool, directory: str = '') -> None:
     as a branch name, and that branch will be checked out.
 
     This will fail if the branch does not exist. If you want to create a new
-    branch, pass the `-b` option."""
+    branch, pass the `-b` option.
+
+    A shallow clone made with `--depth` is much faster to download, but
+    commands needing history, such as finding a mathlib cache for an older
+    commit, may not work in it. A `--partial` clone keeps the whole history
+    and fetches old file contents from GitHub on demand instead."""
+    from git.exc import GitCommandError # type: ignore
+    from mathlibtools.lib import LeanProject, github_ssh_works
 
     original_name = name
     name, url, branch, is_url = parse_project_name(original_name)
     if branch:
         name = name + '_' + branch
+    # an explicitly requested directory must not exist at all, while git can
+    # clone into an existing empty directory named after the project. Other
+    # cases are caught here, before probing the network.
+    target = Path(directory or name)
+    if target.exists() and (directory or not target.is_dir() or any(target.iterdir())):
+        raise FileExistsError('Directory ' + str(target) + ' already exists')
     directory = directory or name
-    if directory and Path(directory).exists():
-        raise FileExistsError('Directory ' + directory + ' already exists')
+    # if full url is provided, do not retry with HTTPS
+    retry_https = not is_url
+    if not is_url:
+        https_url = parse_project_name(original_name, ssh=False)[1]
+        if not github_ssh_works(url, https_url):
+            log.info('Cannot reach the repository via SSH, using HTTPS...')
+            url, retry_https = https_url, False
     try:
         LeanProject.from_git_url(url, directory, branch, new_branch,
-                                 cache_url, force_download)
+                                 opts.cache_url, opts.force_download, depth,
+                                 partial)
     except GitCommandError as err:
-        # if full url is provided, do not retry with HTTPS
-        if not is_url:
+        if retry_https:
             log.info('Error cloning via SSH, trying HTTPS...')
             try:
                 name, url, branch, is_url = parse_project_name(original_name, ssh=False)
                 LeanProject.from_git_url(url, directory, branch, new_branch,
-                                 cache_url, force_download)
+                                 opts.cache_url, opts.force_download, depth,
+                                 partial)
             except GitCommandError as e:
                 handle_exception(e, e.stderr)
         else:
@@ -216,6 +283,7 @@ def get_cache(rev: Optional[str], fallback: str) -> None:
       download-first: show all fallback caches, download and apply the first
       download-all: show and download all fallback caches, apply the first.
     """
+    from mathlibtools.lib import CacheFallback, LeanDownloadError
     fallback_enum = CacheFallback(fallback)
     try:
         proj().get_cache(rev, fallback_enum)
@@ -226,6 +294,7 @@ def get_cache(rev: Optional[str], fallback: str) -> None:
 def get_mathlib_cache() -> None:
     """Get mathlib .lean and .olean files in a project depending on mathlib,
     without upgrading."""
+    from mathlibtools.lib import LeanDownloadError
     project = proj()
     try:
         project.get_mathlib_olean()
@@ -251,28 +320,36 @@ def hooks() -> None:
 @click.argument('url')
 def set_url(url: str) -> None:
     """Set the default url where oleans should be fetched."""
+    from mathlibtools.lib import set_download_url
     set_download_url(url)
 
 @cli.command()
-def check() -> None:
+@click.option('--yes/--no', 'touch', default=None,
+              help='Set the modification time of stale oleans to now, or leave '
+                   'them alone, without asking.')
+def check(touch: Optional[bool] = None) -> None:
     """Check mathlib oleans are more recent than their sources"""
+    from mathlibtools.lib import scan_oleans, touch_files
     project = proj()
-    core_ok, mathlib_ok = project.check_timestamps()
     toolchain = project.toolchain
     toolchain_path = Path.home()/'.elan'/'toolchains'/toolchain
+    # Each tree is walked once, collecting oleans in case they need touching
+    core_ok, core_oleans = scan_oleans(toolchain_path)
+    mathlib_ok, mathlib_oleans = scan_oleans(project.mathlib_folder/'src')
+    if core_ok and mathlib_ok:
+        log.info('Everything looks fine.')
+        return
     if not core_ok:
         print('Some core oleans files in toolchain {} seem older than '
               'their source.'.format(toolchain))
-        touch = input('Do you want to set their modification time to now (y/n) ? ')
-        if touch.lower() in ['y', 'yes']:
-            touch_oleans(toolchain_path)
     if not mathlib_ok:
         print('Some mathlib oleans files seem older than their source.')
-        touch = input('Do you want to set their modification time to now (y/n) ? ')
-        if touch.lower() in ['y', 'yes']:
-            touch_oleans(project.mathlib_folder/'src')
-    if core_ok and mathlib_ok:
-        log.info('Everything looks fine.')
+    if touch is None:
+        touch = input('Do you want to set their modification time to now (y/n) ? '
+                      ).lower() in ['y', 'yes']
+    if touch:
+        touch_files((core_oleans if not core_ok else []) +
+                    (mathlib_oleans if not mathlib_ok else []))
 
 @cli.command()
 def mk_all() -> None:
@@ -280,15 +357,19 @@ def mk_all() -> None:
     proj().make_all()
 
 @cli.command()
-def global_install() -> None:
+@click.pass_obj
+def global_install(opts: CliOpts) -> None:
     """Install mathlib user-wide."""
-    proj = LeanProject.user_wide(cache_url, force_download)
+    from mathlibtools.lib import LeanProject
+    proj = LeanProject.user_wide(opts.cache_url, opts.force_download)
     proj.add_mathlib()
 
 @cli.command()
-def global_upgrade() -> None:
+@click.pass_obj
+def global_upgrade(opts: CliOpts) -> None:
     """Upgrade user-wide mathlib"""
-    proj = LeanProject.user_wide(cache_url, force_download)
+    from mathlibtools.lib import LeanProject
+    proj = LeanProject.user_wide(opts.cache_url, opts.force_download)
     proj.upgrade_mathlib()
 
 @cli.command()
@@ -364,7 +445,10 @@ def import_graph(
         if to:
             # discard stray fragments from before the ported files
             G = G.ancestors(to)
-    G.write(Path(output))
+    try:
+        G.write(Path(output))
+    except subprocess.CalledProcessError as err:
+        handle_exception(err, 'Graphviz failed: ' + err.stderr.strip())
 
 
 @cli.command()
@@ -375,20 +459,26 @@ def port_progress(to: Optional[str]) -> None:
     project = proj()
     project.port_status()
     graph = project.import_graph
-    graph = graph.exclude_tactics()
+    graph = graph.exclude_tactics(reduce=True)
     if to:
         graph = graph.ancestors(to)
-    graph = graph.transitive_reduction()
-    nb_files = graph.size()
-    nb_lines = sum(node.get("nb_lines", 0) for name, node in graph.nodes(data=True))
     mathlib3_longest_path = graph.longest_path_length()
-    graph = graph.delete_ported()
+    unported = graph.delete_ported()
     # Again, to discard stray fragments after deleting ported files
     if to:
-        graph = graph.ancestors(to)
-    nb_ported_files = nb_files - graph.size()
+        unported = unported.ancestors(to)
+    # Files outside the unported graph count as ported, so that all totals
+    # come from a single pass over the nodes
+    nb_files = nb_lines = nb_ported_files = nb_ported_lines = 0
+    for name, node in graph.nodes(data=True):
+        lines = node.get("nb_lines", 0)
+        nb_files += 1
+        nb_lines += lines
+        if name not in unported:
+            nb_ported_files += 1
+            nb_ported_lines += lines
+    graph = unported
     proportion_files = round(nb_ported_files/nb_files*100, 1)
-    nb_ported_lines = nb_lines - sum(node.get("nb_lines", 0) for name, node in graph.nodes(data=True))
     proportion_lines = round(nb_ported_lines/nb_lines*100, 1)
     longest_unported_path = graph.longest_path_length()
     progress_path = round(100 - (longest_unported_path + 1) / mathlib3_longest_path * 100, 1)
@@ -427,8 +517,7 @@ def port_complete() -> None:
     project = proj()
     project.port_status()
     graph = project.import_graph
-    graph = graph.exclude_tactics()
-    graph = graph.transitive_reduction()
+    graph = graph.exclude_tactics(reduce=True)
     R = graph.completely_ported()
     for n in sorted([n for n in R.nodes]):
         print(n)
@@ -465,10 +554,9 @@ def decls(path: str = '') -> None:
     project = proj()
     decls = project.list_decls()
     outpath = Path(path) if path else project.directory/'decls.yaml'
-    with outpath.open('w') as outfile:
-        for name, info in decls.items():
-            outfile.write('{}:\n  origin: {}\n  path: {}\n  line: {}\n'.format(
-                name, info.origin, info.filepath, info.line))
+    with outpath.open('w', buffering=1 << 20) as outfile:
+        outfile.writelines(f'{name}:\n  origin: {info.origin}\n  path: {info.filepath}\n  line: {info.line}\n'
+                           for name, info in decls.items())
 
 
 @cli.command()
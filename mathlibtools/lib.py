@@ -9,20 +9,27 @@ import os
 import stat
 import platform
 import subprocess
+import threading
 import pickle
+import copy
 import contextlib
+import hashlib
+import base64
 import enum
-from datetime import datetime
+import time
 import concurrent.futures
+from functools import lru_cache
 import tarfile
-from typing import Iterable, Union, List, Tuple, Optional, Dict, TYPE_CHECKING
+from typing import (Any, Iterable, Iterator, Union, List, Tuple, Optional, Dict, BinaryIO, IO,
+                    Callable, TYPE_CHECKING)
 from tempfile import TemporaryDirectory
 import shutil
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm import tqdm # type: ignore
 import toml
-import yaml
 from git import (Repo, Commit, InvalidGitRepositoryError,  # type: ignore
                  GitCommandError, BadName, RemoteReference) # type: ignore
 from atomicwrites import atomic_write
@@ -33,7 +40,6 @@ if TYPE_CHECKING:
     from mathlibtools.import_graph import ImportGraph
 
 from mathlibtools.delayed_interrupt import DelayedInterrupt
-from mathlibtools.auth_github import auth_github, Github
 from mathlibtools.git_helpers import visit_ancestors, short_sha
 
 log = logging.getLogger("Mathlib tools")
@@ -67,8 +73,36 @@ DOT_MATHLIB = Path(os.environ.get("MATHLIB_CACHE_DIR") or
 
 AZURE_URL = 'https://oleanstorage.azureedge.net/mathlib/'
 
+# Size of the chunks read from the network when downloading caches
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Caches downloaded without being extracted on the way are fetched as this
+# many concurrent byte ranges, when they are at least PARALLEL_DOWNLOAD_MIN_SIZE
+# bytes and the server supports it
+DOWNLOAD_PARTS = 4
+PARALLEL_DOWNLOAD_MIN_SIZE = 16 * 1024 * 1024
+# Size of the buffer used by tarfile to copy extracted files (default is 16 KiB)
+EXTRACT_BUFFER_SIZE = 2 * 1024 * 1024
+
+# Used for all HTTP requests, so that connections to the cache server are
+# reused between caches and between the parts of a download. Connection
+# errors and server errors are retried a few times, and a response which is
+# still an error is returned as usual so that raise_for_status reports it.
+HTTP_RETRY = Retry(total=5, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504],
+                   raise_on_status=False)
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount('https://', HTTPAdapter(pool_maxsize=16, max_retries=HTTP_RETRY))
+HTTP_SESSION.mount('http://', HTTPAdapter(pool_maxsize=16, max_retries=HTTP_RETRY))
+# Archives are already compressed, and downloads read the raw stream, which
+# would otherwise still carry any content encoding added by a proxy
+HTTP_SESSION.headers['Accept-Encoding'] = 'identity'
+
 DOT_MATHLIB.mkdir(parents=True, exist_ok=True)
 DOWNLOAD_URL_FILE = DOT_MATHLIB/'url'
+# Remembers whether GitHub was reachable over SSH, see github_ssh_works
+SSH_PROBE_FILE = DOT_MATHLIB/'github-ssh'
+SSH_PROBE_TTL = 24 * 60 * 60
+# Seconds ssh waits for a connection when probing whether SSH works
+SSH_CONNECT_TIMEOUT = 2
 
 MATHLIB_URL = 'https://github.com/leanprover-community/mathlib.git'
 LEAN_VERSION_RE = re.compile(r'(.*)\t.*refs/heads/lean-(.*)')
@@ -79,10 +113,28 @@ LEAN_UNESCAPED_IDENTIFIER_RE = re.compile(
     r"(?![λΠΣ])[_a-zA-Zα-ωΑ-Ωϊ-ϻἀ-῾℀-⅏𝒜-𝖟](?:(?![λΠΣ])[_a-zA-Zα-ωΑ-Ωϊ-ϻἀ-῾℀-⅏𝒜-𝖟0-9'ⁿ-₉ₐ-ₜᵢ-ᵪ])*")
 
 VersionTuple = Tuple[int, int, int]
+# Lean versions as found in a branch name or modern leanpkg.toml, in the output
+# of `lean --version`, or on their own
+LEAN_VERSION_BRANCH_RE = re.compile(r'lean[-:](\d+)\.(\d+)\.(\d+)')
+LEAN_VERSION_OUTPUT_RE = re.compile(r'version (\d+)\.(\d+)\.(\d+),')
+LEAN_VERSION_PLAIN_RE = re.compile(r'(\d+)\.(\d+)\.(\d+)')
+
+# Make git give up on clones stalled below 1kB/s for 30 seconds, unless the
+# user configured this already
+GIT_CLONE_ENV = {k: v for k, v in [('GIT_HTTP_LOW_SPEED_LIMIT', '1000'),
+                                   ('GIT_HTTP_LOW_SPEED_TIME', '30')]
+                 if k not in os.environ}
+# Seconds to wait before each new attempt at a clone which failed because of
+# the network
+CLONE_RETRY_DELAYS = (5, 15)
+TRANSIENT_GIT_ERRORS = ('Could not resolve host', 'Connection timed out',
+                        'Operation timed out', 'Connection reset',
+                        'The requested URL returned error: 5', 'early EOF',
+                        'RPC failed', 'transfer closed')
 
 def mathlib_lean_version() -> VersionTuple:
     """Return the latest Lean release supported by mathlib"""
-    resp = requests.get("https://raw.githubusercontent.com/leanprover-community/mathlib/master/leanpkg.toml")
+    resp = HTTP_SESSION.get("https://raw.githubusercontent.com/leanprover-community/mathlib/master/leanpkg.toml")
     assert resp.status_code == 200
     conf = toml.loads(resp.text)
     return parse_version(conf['package']['lean_version'])
@@ -98,33 +150,212 @@ def get_download_url() -> str:
 if not DOWNLOAD_URL_FILE.exists():
     set_download_url()
 
-def pack(root: Path, srcs: Iterable[Path], target: Path) -> None:
-    """Creates, as target, a tar.xz archive containing all paths from src,
-    relative to the folder root"""
+def git_probe_env() -> Dict[str, str]:
+    """The environment for git commands which must never ask the user
+    anything. GIT_TERMINAL_PROMPT only covers git's own prompts, while ssh
+    opens the terminal itself to confirm host keys or ask for passphrases, so
+    it also runs in batch mode, unless the user configured their own ssh
+    command."""
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    if 'GIT_SSH_COMMAND' in env or 'GIT_SSH' in env:
+        return env
     try:
-        target.unlink()
-    except FileNotFoundError:
+        ssh_command = subprocess.run(['git', 'config', '--get', 'core.sshCommand'],
+                                     stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL,
+                                     universal_newlines=True).stdout.strip()
+    except OSError:
+        ssh_command = ''
+    if not ssh_command:
+        env['GIT_SSH_COMMAND'] = 'ssh -o BatchMode=yes -o ConnectTimeout={}'.format(
+            SSH_CONNECT_TIMEOUT)
+    return env
+
+def git_remote_exists(url: str, timeout: float = 10) -> bool:
+    """Check whether the git repository at url can be reached without any
+    prompt, giving up after timeout seconds."""
+    env = git_probe_env()
+    try:
+        return subprocess.run(['git', 'ls-remote', '--exit-code', url, 'HEAD'],
+                              stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL, env=env,
+                              timeout=timeout).returncode == 0
+    except (subprocess.TimeoutExpired, OSError):
+        return False
+
+def github_ssh_works(ssh_url: str, https_url: str) -> bool:
+    """Tell whether the repository should be cloned from ssh_url rather than
+    https_url. Both are probed at the same time, so that a blocked SSH port
+    does not delay HTTPS, and the answer is remembered for SSH_PROBE_TTL
+    seconds since it depends on the network rather than on the repository."""
+    try:
+        if time.time() - SSH_PROBE_FILE.stat().st_mtime < SSH_PROBE_TTL:
+            return SSH_PROBE_FILE.read_text().strip() == 'ok'
+    except OSError:
         pass
-    cur_dir = Path.cwd()
-    with DelayedInterrupt([signal.SIGTERM, signal.SIGINT]):
-        os.chdir(str(root))
-        ar = tarfile.open(str(target), 'w|xz')
-        for src in srcs:
-            ar.add(str(src.relative_to(root)))
-        ar.close()
-    os.chdir(str(cur_dir))
-
-def unpack_archive(fname: Union[str, Path], tgt_dir: Union[str, Path],
-                   oleans_only: bool) -> None:
-    """ Alternative to `shutil.unpack_archive` that shows progress"""
-    with tarfile.open(fname) as tarobj:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        ssh_ok, https_ok = executor.map(git_remote_exists, [ssh_url, https_url])
+    # if neither works the repository itself is unreachable, which says
+    # nothing about SSH
+    if ssh_ok or https_ok:
+        SSH_PROBE_FILE.write_text('ok' if ssh_ok else 'no')
+    return ssh_ok or not https_ok
+
+def pack(root: Path, srcs: Iterable[Path], target: Path) -> None:
+    """Creates, as target, a tar.xz archive containing all paths from src,
+    relative to the folder root. The archive is written to a temporary file
+    renamed to target once complete, so that target is never left partial."""
+    with DelayedInterrupt([signal.SIGTERM, signal.SIGINT]), \
+            atomic_write(str(target), mode='wb', overwrite=True) as out:
+        xz = shutil.which('xz')
+        if not xz:
+            with tarfile.open(fileobj=out, mode='w|xz') as ar:
+                for src in srcs:
+                    ar.add(str(src), arcname=str(src.relative_to(root)))
+            return
+        # The xz program can compress using several threads, while python's
+        # lzma module only uses one. It runs in its own session, so that an
+        # interrupt from the terminal only reaches us and is delayed.
+        proc = subprocess.Popen([xz, '-zc', '-T0'], stdin=subprocess.PIPE,
+                                stdout=out, start_new_session=True)
+        try:
+            assert proc.stdin
+            with proc.stdin, tarfile.open(fileobj=proc.stdin, mode='w|',
+                                          bufsize=DOWNLOAD_CHUNK_SIZE) as ar:
+                for src in srcs:
+                    ar.add(str(src), arcname=str(src.relative_to(root)))
+            if proc.wait():
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+
+# First xz release able to decompress using several threads
+XZ_PARALLEL_DECODE_VERSION = (5, 3, 3)
+
+@lru_cache(maxsize=1)
+def xz_decompress_command() -> Optional[List[str]]:
+    """A command decompressing xz data from stdin to stdout, or None if no
+    suitable program is installed. Multithreaded decoders are preferred: a
+    recent enough xz, then pixz, then older versions of xz which still run
+    alongside the extraction."""
+    xz = shutil.which('xz')
+    if xz:
+        try:
+            out = subprocess.run([xz, '--version'], stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL,
+                                 universal_newlines=True).stdout
+            match = re.search(r'(\d+)\.(\d+)\.(\d+)', out)
+            if match and tuple(map(int, match.groups())) >= XZ_PARALLEL_DECODE_VERSION:
+                return [xz, '-dc', '-T0']
+        except OSError:
+            xz = None
+    pixz = shutil.which('pixz')
+    if pixz:
+        return [pixz, '-d']
+    return [xz, '-dc'] if xz else None
+
+def unpack_process_output(proc: subprocess.Popen, tgt_dir: Union[str, Path],
+                          oleans_only: bool) -> None:
+    """ Extract the uncompressed archive written to the standard output of
+    `proc`, then wait for it and raise CalledProcessError if it failed. """
+    assert proc.stdout
+    with proc.stdout:
+        unpack_archive(proc.stdout, tgt_dir, oleans_only)
+        # let the decompressor write the padding after the end of the archive
+        while proc.stdout.read(DOWNLOAD_CHUNK_SIZE):
+            pass
+    if proc.wait():
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+def unpack_archive(fname: Union[str, Path, IO[bytes]], tgt_dir: Union[str, Path],
+                   oleans_only: bool, xz: bool = False) -> None:
+    """ Alternative to `shutil.unpack_archive` that shows progress
+
+    `fname` can also be an open file object, in which case `xz` tells whether
+    it is compressed with xz. In both cases the archive is read in a single
+    sequential pass."""
+    if isinstance(fname, (str, Path)):
+        xz_cmd = xz_decompress_command() if str(fname).endswith('.xz') else None
+        if xz_cmd:
+            # An external decompressor can use several threads, and at least
+            # runs alongside the extraction, while python's lzma module
+            # decompresses in the same thread.
+            with open(str(fname), 'rb') as src:
+                proc = subprocess.Popen(xz_cmd, stdin=src, stdout=subprocess.PIPE)
+            unpack_process_output(proc, tgt_dir, oleans_only)
+            return
+        tarobj = tarfile.open(str(fname), mode='r|*', bufsize=DOWNLOAD_CHUNK_SIZE)
+    else:
+        xz_cmd = xz_decompress_command() if xz else None
+        if xz_cmd:
+            # Same as above, with a thread writing the source to the
+            # decompressor, so that e.g. a download also overlaps with it
+            proc = subprocess.Popen(xz_cmd, stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+            errors: List[BaseException] = []
+            def feed() -> None:
+                assert proc.stdin
+                try:
+                    with proc.stdin:
+                        for block in blocks(fname, DOWNLOAD_CHUNK_SIZE):
+                            proc.stdin.write(block)
+                except BrokenPipeError:
+                    pass  # the extraction failed, and reports why
+                except BaseException as err:
+                    errors.append(err)
+            feeder = threading.Thread(target=feed, daemon=True)
+            feeder.start()
+            try:
+                unpack_process_output(proc, tgt_dir, oleans_only)
+            except Exception:
+                # if reading the source failed, this is why the decompressor
+                # or the extraction failed, and the more useful error
+                feeder.join()
+                if errors:
+                    raise errors[0]
+                raise
+            feeder.join()
+            if errors:
+                raise errors[0]
+            return
+        # tarfile reads its source in bufsize blocks (10 KiB by default), and
+        # each read of a download goes through the progress bar and the tee
+        tarobj = tarfile.open(fileobj=fname, mode='r|*', bufsize=DOWNLOAD_CHUNK_SIZE)
+    # only used by python >= 3.8, older versions ignore it
+    tarobj.copybufsize = EXTRACT_BUFFER_SIZE # type: ignore
+    with tarobj:
         if oleans_only:
-            members : Iterable[tarfile.TarInfo] = (f for f in tarobj if Path(f.name).suffix == '.olean')
+            members : Iterable[tarfile.TarInfo] = (f for f in tarobj if f.name.endswith('.olean'))
         else:
             members = tarobj
         tarobj.extractall(
             str(tgt_dir), members=tqdm(members, desc='  files extracted', unit=''))
 
+def move_tree(src: Path, tgt: Path) -> None:
+    """Move every file below src to the same relative path below tgt,
+    replacing existing files. Both must be on the same filesystem."""
+    for dirpath, _, filenames in os.walk(str(src)):
+        dest = os.path.join(str(tgt), os.path.relpath(dirpath, str(src)))
+        os.makedirs(dest, exist_ok=True)
+        for name in filenames:
+            os.replace(os.path.join(dirpath, name), os.path.join(dest, name))
+
+class TeeReader:
+    """ A file-like object copying everything read from `src` into `tgt`,
+    and computing its MD5 hash on the way """
+    def __init__(self, src: BinaryIO, tgt: BinaryIO):
+        self.src = src
+        self.tgt = tgt
+        self.md5 = hashlib.md5()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.src.read(size)
+        self.tgt.write(data)
+        self.md5.update(data)
+        return data
+
 def escape_identifier(s : str) -> str:
     """ Helper function to wrap _pieces_ of identifiers in double french quotes
     if they need to be wrapped by lean, we use this for file paths so we also escape
@@ -159,6 +390,18 @@ class OleanCache:
     def make_local(self) -> 'LocalOleanCache':
         raise NotImplementedError
 
+    def unpack(self, tgt_dir: Path, oleans_only: bool,
+               prepare: Optional[Callable[[], None]] = None) -> 'LocalOleanCache':
+        """ Extract the cache into `tgt_dir`, returning its local version.
+
+        `prepare` is called once the whole archive is available, right before
+        `tgt_dir` is modified. """
+        local = self.make_local()
+        if prepare:
+            prepare()
+        unpack_archive(local.path, tgt_dir, oleans_only)
+        return local
+
     def close(self) -> None:
         pass
 
@@ -185,26 +428,131 @@ class LocalOleanCache(OleanCache):
 class RemoteOleanCache(OleanCache):
     """ A cache of oleans that lives on a remove server.
 
-    This holds an open HTTP connection to the server from which the cache can be downloaded."""
+    Its existence is checked with a HEAD request, so that caches which are
+    only listed do not hold an open download. The download itself is started
+    when needed, and holds an HTTP connection until the cache is closed."""
     def __init__(self, locator: 'CacheLocator', rev):
         super().__init__(locator, rev)
         assert self.locator.cache_url is not None
-        self.req = requests.get(self.locator.cache_url + self.fname, stream=True)
-        self.req.raise_for_status()
+        self.url = self.locator.cache_url + self.fname
+        self.req: Optional[requests.Response] = None
+        head = HTTP_SESSION.head(self.url, allow_redirects=True)
+        if head.status_code in (405, 501):
+            # the server does not support HEAD requests
+            self.headers = self.open().headers
+        else:
+            head.raise_for_status()
+            self.headers = head.headers
 
-    def close(self):
-        self.req.close()
+    def open(self) -> requests.Response:
+        """ The streamed download of the cache, started on the first call """
+        if self.req is None:
+            self.req = HTTP_SESSION.get(self.url, stream=True)
+            self.req.raise_for_status()
+        return self.req
 
-    def make_local(self):
-        # download the cache atomically from the already-open connection
+    def close(self):
+        if self.req is not None:
+            self.req.close()
+
+    def download(self, consume: Callable[[BinaryIO], None]) -> 'LocalOleanCache':
+        """ Download the cache atomically from the already-open connection,
+        letting `consume` read the stream on the way.
+
+        If the server gives the MD5 hash of the archive, the download is
+        checked against it and LeanDownloadError is raised on mismatch,
+        without keeping anything in the local cache. This happens after
+        `consume` read everything, so it must not expose what it read before
+        this returns, as `unpack` does with its staging directory."""
+        req = self.open()
         with atomic_write(self.path, mode='wb', overwrite=True) as tgt:
-            total_size = int(self.req.headers.get('content-length', 0))
-            with tqdm.wrapattr(self.req.raw, "read", total=total_size,
+            total_size = int(req.headers.get('content-length', 0))
+            with tqdm.wrapattr(req.raw, "read", total=total_size,
                                desc='  ' + short_sha(self.rev)) as src:
-                shutil.copyfileobj(src, tgt)
-        self.req.close()
+                tee = TeeReader(src, tgt)
+                consume(tee) # type: ignore  # TeeReader only implements read
+                # read whatever `consume` left, e.g. tarfile stops at the
+                # end-of-archive marker but the local copy needs the padding
+                while tee.read(DOWNLOAD_CHUNK_SIZE):
+                    pass
+            expected_md5 = req.headers.get('Content-MD5')
+            if expected_md5 and base64.b64decode(expected_md5) != tee.md5.digest():
+                raise LeanDownloadError(
+                    f'Corrupted download of the cache for {short_sha(self.rev)}')
+        req.close()
         return LocalOleanCache(self.locator, self.rev)
 
+    def download_parts(self, total_size: int) -> 'LocalOleanCache':
+        """ Download the cache atomically as DOWNLOAD_PARTS byte ranges fetched
+        concurrently, since a single connection often cannot use the whole
+        bandwidth. This closes the single download if it was started.
+
+        The MD5 hash given by the server is checked as in `download`."""
+        self.close()
+        url = self.url
+        bounds = [total_size * i // DOWNLOAD_PARTS for i in range(DOWNLOAD_PARTS + 1)]
+        with atomic_write(self.path, mode='wb', overwrite=True) as tgt, \
+                tqdm(total=total_size, unit='B', unit_scale=True,
+                     desc='  ' + short_sha(self.rev)) as progress:
+            tgt.truncate(total_size)
+            tgt.flush()
+            def fetch(start: int, end: int) -> None:
+                headers = {'Range': 'bytes={}-{}'.format(start, end - 1)}
+                with HTTP_SESSION.get(url, headers=headers, stream=True) as resp, \
+                        open(tgt.name, 'r+b') as part:
+                    resp.raise_for_status()
+                    if resp.status_code != 206:
+                        raise LeanDownloadError(
+                            f'The server ignored a range request for {url}')
+                    part.seek(start)
+                    while True:
+                        data = resp.raw.read(DOWNLOAD_CHUNK_SIZE)
+                        if not data:
+                            break
+                        part.write(data)
+                        progress.update(len(data))
+                    if part.tell() != end:
+                        raise LeanDownloadError(
+                            f'Incomplete download of the cache for {short_sha(self.rev)}')
+            with concurrent.futures.ThreadPoolExecutor(max_workers=DOWNLOAD_PARTS) as executor:
+                # consume the results so that errors are raised here
+                for _ in executor.map(fetch, bounds[:-1], bounds[1:]):
+                    pass
+            expected_md5 = self.headers.get('Content-MD5')
+            if expected_md5:
+                md5 = hashlib.md5()
+                with open(tgt.name, 'rb') as downloaded:
+                    for block in blocks(downloaded, DOWNLOAD_CHUNK_SIZE):
+                        md5.update(block)
+                if base64.b64decode(expected_md5) != md5.digest():
+                    raise LeanDownloadError(
+                        f'Corrupted download of the cache for {short_sha(self.rev)}')
+        return LocalOleanCache(self.locator, self.rev)
+
+    def make_local(self):
+        # nothing needs to read the archive as it arrives, so it can be
+        # fetched in several parts
+        total_size = int(self.headers.get('content-length', 0))
+        if (total_size >= PARALLEL_DOWNLOAD_MIN_SIZE and
+                self.headers.get('Accept-Ranges') == 'bytes'):
+            return self.download_parts(total_size)
+        return self.download(lambda src: None)
+
+    def unpack(self, tgt_dir: Path, oleans_only: bool,
+               prepare: Optional[Callable[[], None]] = None) -> 'LocalOleanCache':
+        # extract the archive while it is downloading, into a directory next
+        # to `tgt_dir` which is only moved into place once the download
+        # succeeded, so that a failure leaves `tgt_dir` untouched
+        tgt_dir = tgt_dir.absolute()
+        with TemporaryDirectory(dir=str(tgt_dir.parent),
+                                prefix='.{}-'.format(tgt_dir.name)) as staging:
+            local = self.download(lambda src: unpack_archive(
+                src, staging, oleans_only, xz=self.fname.endswith('.xz')))
+            if prepare:
+                prepare()
+            move_tree(Path(staging), tgt_dir)
+        return local
+
 
 class CacheFallback(enum.Enum):
     """ Specifies the fallback to use when an exactly matching cache is not available """
@@ -272,6 +620,16 @@ class CacheLocator:
         """
         Find (or download) a local cache for `rev` using the provided fallback strategy.
         """
+        with self.find_with_fallback(rev, fallback) as cache:
+            return cache.make_local()
+
+    @contextlib.contextmanager
+    def find_with_fallback(self, rev: Commit, fallback: CacheFallback) -> Iterator[OleanCache]:
+        """
+        Find a cache for `rev` using the provided fallback strategy. This is a
+        context manager so that a remote cache can be unpacked while it is
+        downloading, its HTTP connection is closed on exit.
+        """
         # if fallback is `NONE`, do not even attempt a search (to conserve network access)
         if fallback == CacheFallback.NONE:
             cache = self.find_exact(rev)
@@ -279,7 +637,8 @@ class CacheLocator:
                 raise LeanDownloadError(f"No cache was available for {short_sha(rev)}.\n")
             with cache:
                 log.info("Located matching cache")
-                return cache.make_local()
+                yield cache
+                return
 
         # Otherwise, do a search. This will open as many HTTP connections as
         # necessary, which the `with` statement cleans up.
@@ -294,7 +653,8 @@ class CacheLocator:
             if cache.rev == rev:
                 assert len(caches) == 1
                 log.info("Using matching cache")
-                return caches[0].make_local()
+                yield cache
+                return
 
             if len(caches) > 1:
                 archive_items = ''.join([f'\n * {short_sha(c.rev)}' for c in caches])
@@ -315,34 +675,22 @@ class CacheLocator:
                 log.info("Preparing all caches, using the first")
                 with concurrent.futures.ThreadPoolExecutor() as executor:
                     local_caches = list(executor.map(lambda c: c.make_local(), caches))
-                return local_caches[0]
+                yield local_caches[0]
             elif fallback == CacheFallback.DOWNLOAD_FIRST:
                 log.info("Using first cache")
-                return caches[0].make_local()
+                yield cache
             elif fallback == CacheFallback.SHOW:
                 log.info(f"Run `leanproject get-cache --rev` on one of the available commits above.")
                 raise LeanDownloadError
             else:
                 raise RuntimeError('Invalid fallback argument')
 
-        # https://github.com/python/mypy/issues/7726
-        assert False
-
 def parse_version(version: str) -> VersionTuple:
     """Turn a lean version string into a tuple of integers or raise
     InvalidLeanVersion"""
-    #Something that could be in a branch name or modern leanpkg.toml
-    m = re.match(r'.*lean[-:](.*)\.(.*)\.(.*).*', version)
-    if m:
-        return (int(m.group(1)), int(m.group(2)), int(m.group(3)))
-
-    # The output of `lean -- version`
-    m = re.match(r'.*version (.*)\.(.*)\.(.*),.*', version)
-    if m:
-        return (int(m.group(1)), int(m.group(2)), int(m.group(3)))
-
-    # Only a version string
-    m = re.match(r'(.*)\.(.*)\.(.*)', version)
+    m = (LEAN_VERSION_BRANCH_RE.search(version) or
+         LEAN_VERSION_OUTPUT_RE.search(version) or
+         LEAN_VERSION_PLAIN_RE.match(version))
     if m:
         return (int(m.group(1)), int(m.group(2)), int(m.group(3)))
     raise InvalidLeanVersion(version)
@@ -355,46 +703,143 @@ def lean_version_toml(version: VersionTuple) -> str:
     else:
         return 'leanprover-community/lean:' + ver_str
 
+def walk_files(root: Path, suffix: Union[str, Tuple[str, ...]]) -> Iterator['os.DirEntry[str]']:
+    """Yields the directory entries of files in root and its subfolders whose
+    name ends with suffix (or one of several suffixes). Like Path.glob('**/*' + suffix), this does not
+    follow symbolic links to directories, but it avoids building a Path and
+    calling stat for each file."""
+    if not root.is_dir():
+        return
+    todo = [str(root)]
+    while todo:
+        with os.scandir(todo.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    todo.append(entry.path)
+                elif entry.name.endswith(suffix):
+                    yield entry
+
+def oleans_up_to_date(root: Path) -> bool:
+    """Check that oleans in root and its subfolders are more recent than
+    their source, stopping at the first one which is not."""
+    try:
+        for entry in walk_files(root, '.lean'):
+            olean = entry.path[:-len('.lean')] + '.olean'
+            if entry.stat().st_mtime_ns >= os.stat(olean).st_mtime_ns:
+                return False
+    except FileNotFoundError:
+        return False
+    return True
+
+def scan_oleans(root: Path) -> Tuple[bool, List[str]]:
+    """Check that oleans in root and its subfolders are more recent than
+    their source, and collect the paths of all oleans in the same walk, so
+    that they can be touched without walking the tree again."""
+    ok = True
+    oleans = []
+    for entry in walk_files(root, ('.lean', '.olean')):
+        if entry.name.endswith('.olean'):
+            oleans.append(entry.path)
+        elif ok:
+            olean = entry.path[:-len('.lean')] + '.olean'
+            try:
+                ok = entry.stat().st_mtime_ns < os.stat(olean).st_mtime_ns
+            except FileNotFoundError:
+                ok = False
+    return ok, oleans
+
 def clean(dir: Path) -> None:
     log.info('cleaning {} ...'.format(str(dir)))
-    for path in dir.glob('**/*.olean'):
-        path.unlink()
+    # collect paths first, so that directories do not change while scanned
+    for path in [entry.path for entry in walk_files(dir, '.olean')]:
+        os.unlink(path)
 
 def delete_zombies(dir: Path) -> None:
-    for path in dir.glob('**/*.olean'):
-        if not path.with_suffix('.lean').exists():
-            log.info('deleting zombie {} ...'.format(str(path)))
-            path.unlink()
+    """Delete oleans in dir and its subfolders which have no source, finding
+    both in a single walk."""
+    sources = set()
+    oleans = []
+    for entry in walk_files(dir, ('.lean', '.olean')):
+        if entry.name.endswith('.olean'):
+            oleans.append(entry.path[:-len('.olean')])
+        else:
+            sources.add(entry.path[:-len('.lean')])
+    for stem in oleans:
+        if stem not in sources:
+            log.info('deleting zombie {}.olean ...'.format(stem))
+            os.unlink(stem + '.olean')
 
 def check_core_timestamps(toolchain: str) -> bool:
     """Check that oleans are more recent than their source in core lib"""
 
     toolchain_path = Path.home()/'.elan'/'toolchains'/toolchain
-    try:
-        return all(p.stat().st_mtime < p.with_suffix('.olean').stat().st_mtime
-               for p in toolchain_path.glob('**/*.lean'))
-    except FileNotFoundError:
-        return False
+    return oleans_up_to_date(toolchain_path)
 
 def touch_oleans(path: Path) -> None:
     """Set modification time for oleans in path and its subfolders to now"""
-    now = datetime.now().timestamp()
-    for p in path.glob('**/*.olean'):
-        os.utime(str(p), (now, now))
+    touch_files(entry.path for entry in walk_files(path, '.olean'))
+
+# Number of files touched by each task of touch_files
+TOUCH_CHUNK_SIZE = 256
+
+def touch_files(paths: Iterable[str]) -> None:
+    """Set modification time for all files in paths to now. This is done from
+    several threads, since each utime call mostly waits on the filesystem."""
+    now = time.time()
+    times = (now, now)
+    def touch(chunk: List[str]) -> None:
+        for path in chunk:
+            os.utime(path, times)
+    paths = list(paths)
+    chunks = [paths[i:i + TOUCH_CHUNK_SIZE]
+              for i in range(0, len(paths), TOUCH_CHUNK_SIZE)]
+    if len(chunks) <= 1:
+        for chunk in chunks:
+            touch(chunk)
+        return
+    workers = min(32, 4 * (os.cpu_count() or 1), len(chunks))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        # consume the results so that errors are raised here
+        for _ in executor.map(touch, chunks):
+            pass
+
+@lru_cache(maxsize=32)
+def _parse_toml(path: str, mtime_ns: int, size: int) -> Dict:
+    """Parse the toml file at path, cached as long as it is not modified."""
+    return toml.load(path)
+
+def load_toml(path: Path) -> Dict:
+    """Parse the toml file at path, only reading it again if it changed since
+    the last call. The result can be modified by the caller."""
+    st = path.stat()
+    return copy.deepcopy(_parse_toml(str(path), st.st_mtime_ns, st.st_size))
 
 def find_root(path: Path) -> Path:
     """
     Find a Lean project root in path by searching for leanpkg.toml in path and
     its ancestors.
     """
-    if (path/'leanpkg.toml').exists():
-        return path
-    parent = path.absolute().parent
-    if parent != path:
-        return find_root(parent)
-    else:
-        raise InvalidLeanProject('Could not find a leanpkg.toml')
-
+    for candidate in (path, *path.absolute().parents):
+        if (candidate/'leanpkg.toml').exists():
+            return candidate
+    raise InvalidLeanProject('Could not find a leanpkg.toml')
+
+
+def read_decls(lines: Iterable[str]) -> Dict[str, Dict[str, Optional[str]]]:
+    """Parse the decls.yaml file written by decls.lean. It is a YAML mapping
+    with a fixed layout, a quoted name line followed by File and Line lines,
+    which is read directly since a YAML loader is slow on all of mathlib.
+    Empty values are None, as they would be in YAML."""
+    decls = dict()
+    lines = iter(lines)
+    for name_line in lines:
+        # '"name":'
+        name = name_line.strip()[1:-2]
+        # '  File: value' and '  Line: value'
+        file, line = (next(lines).partition(':')[2].strip() or None
+                      for _ in range(2))
+        decls[name] = {'File': file, 'Line': line}
+    return decls
 
 class DeclInfo:
     def __init__(self, origin: str, filepath: Path, line: int):
@@ -448,7 +893,7 @@ class LeanProject:
             except ValueError:
                 rev = ''
         directory = find_root(path)
-        config = toml.load(directory/'leanpkg.toml')
+        config = load_toml(directory/'leanpkg.toml')
 
         return cls(repo, is_dirty, rev, directory,
                    config['package'], config['dependencies'],
@@ -463,7 +908,7 @@ class LeanProject:
         version of Lean supported by mathlib."""
         directory = Path.home()/'.lean'
         try:
-            config = toml.load(directory/'leanpkg.toml')
+            config = load_toml(directory/'leanpkg.toml')
         except FileNotFoundError:
             directory.mkdir(exist_ok=True)
             version = mathlib_lean_version()
@@ -541,7 +986,7 @@ class LeanProject:
 
     def read_config(self) -> None:
         try:
-            config = toml.load(self.directory/'leanpkg.toml')
+            config = load_toml(self.directory/'leanpkg.toml')
         except FileNotFoundError:
             raise InvalidLeanProject('Missing leanpkg.toml')
 
@@ -596,11 +1041,12 @@ class LeanProject:
 
         # We want an exact match here; if we can't find one, then the user should
         # just point their config file at a version of mathlib with a cache.
-        cache = cache_locator.find_local_with_fallback(commit, fallback=CacheFallback.NONE)
-        log.info("Applying cache")
-        self.clean_mathlib_dep()
-        self.mathlib_folder.mkdir(parents=True, exist_ok=True)
-        unpack_archive(cache.path, self.mathlib_folder, oleans_only=False)
+        with cache_locator.find_with_fallback(commit, fallback=CacheFallback.NONE) as cache:
+            log.info("Applying cache")
+            def prepare() -> None:
+                self.clean_mathlib_dep()
+                self.mathlib_folder.mkdir(parents=True, exist_ok=True)
+            cache.unpack(self.mathlib_folder, oleans_only=False, prepare=prepare)
         if cache.rev != repo.head.commit:
             # If the commit we unpacked isn't HEAD, then there might be some
             # zombie olean files around. It is probably safe, but slower, to do
@@ -646,9 +1092,9 @@ class LeanProject:
                                          force_download=self.force_download)
 
         commit = self.repo.rev_parse(rev) if rev is not None else self.repo.head.commit
-        cache = cache_locator.find_local_with_fallback(commit, fallback)
-        log.info("Applying cache")
-        unpack_archive(cache.path, self.directory, oleans_only=True)
+        with cache_locator.find_with_fallback(commit, fallback) as cache:
+            log.info("Applying cache")
+            cache.unpack(self.directory, oleans_only=True)
         if cache.rev != self.repo.head.commit:
             # If the commit we unpacked isn't HEAD, then there might be some
             # zombie olean files around. It is probably safe, but slower, to do
@@ -661,11 +1107,38 @@ class LeanProject:
     def from_git_url(cls, url: str, target: str = '',
                      branch: str = '', create_branch: bool = False,
                      cache_url: str = '',
-                     force_download: bool = False) -> 'LeanProject':
-        """Download a Lean project using git and prepare mathlib if needed."""
+                     force_download: bool = False,
+                     depth: int = 0, partial: bool = False) -> 'LeanProject':
+        """Download a Lean project using git and prepare mathlib if needed.
+
+        If depth is positive, only this many commits of history are cloned.
+        If partial is True, file contents are only downloaded for the
+        checked out commit, and later fetched by git when needed."""
         log.info('Cloning from ' + url)
         target = target or url.split('/')[-1].split('.')[0]
-        repo = Repo.clone_from(url, target)
+        clone_args: Dict[str, Any] = {}
+        if depth:
+            clone_args['depth'] = depth
+            # a shallow clone only fetches one branch, so it has to be the
+            # one we want to check out
+            if branch and not create_branch:
+                clone_args['branch'] = branch
+        if partial:
+            clone_args['filter'] = 'blob:none'
+        # git can clone into an existing empty directory, which must be kept
+        created = not os.path.exists(target)
+        for delay in CLONE_RETRY_DELAYS + (0,):
+            try:
+                repo = Repo.clone_from(url, target, env=GIT_CLONE_ENV, **clone_args)
+                break
+            except GitCommandError as err:
+                if not delay or not any(msg in str(err.stderr)
+                                        for msg in TRANSIENT_GIT_ERRORS):
+                    raise
+                log.info('Cloning failed, retrying in {} seconds...'.format(delay))
+                if created:
+                    shutil.rmtree(target, ignore_errors=True)
+                time.sleep(delay)
         if create_branch and branch:
             try:
                 repo.git.checkout('HEAD', '-b', branch)
@@ -827,12 +1300,7 @@ class LeanProject:
     def check_timestamps(self) -> Tuple[bool, bool]:
         """Check that core and mathlib oleans are more recent than their
         sources. Return a tuple (core_ok, mathlib_ok)"""
-        try:
-            mathlib_ok = all(p.stat().st_mtime < p.with_suffix('.olean').stat().st_mtime
-                             for p in (self.mathlib_folder/'src').glob('**/*.lean'))
-        except FileNotFoundError:
-            mathlib_ok = False
-
+        mathlib_ok = oleans_up_to_date(self.mathlib_folder/'src')
         return (check_core_timestamps(self.toolchain), mathlib_ok)
 
     @property
@@ -844,19 +1312,26 @@ class LeanProject:
         if self._import_graph:
             return self._import_graph
         G = ImportGraph(self.directory)
-        for path in self.src_directory.glob('**/*.lean'):
-            rel = path.relative_to(self.src_directory)
-            label = str(rel.with_suffix('')).replace(os.sep, '.')
-            G.add_node(label)
-            imports = self.run(['lean', '--deps', str(path)])
-            for imp in map(Path, imports.split()):
-                try:
-                    imp_rel = imp.relative_to(self.src_directory.resolve())
-                except ValueError:
-                    # This import is not from the project
-                    continue
-                imp_label = str(imp_rel.with_suffix('')).replace(os.sep, '.')
-                G.add_edge(imp_label, label)
+        paths = list(self.src_directory.glob('**/*.lean'))
+        src_directory = self.src_directory.resolve()
+        # Each `lean --deps` call mostly waits for Lean to start, and Lean
+        # cannot list the imports of several files separately in one call,
+        # so the calls run concurrently
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            all_imports = executor.map(
+                lambda path: self.run(['lean', '--deps', str(path)]), paths)
+            for path, imports in zip(paths, all_imports):
+                rel = path.relative_to(self.src_directory)
+                label = str(rel.with_suffix('')).replace(os.sep, '.')
+                G.add_node(label)
+                for imp in map(Path, imports.split()):
+                    try:
+                        imp_rel = imp.relative_to(src_directory)
+                    except ValueError:
+                        # This import is not from the project
+                        continue
+                    imp_label = str(imp_rel.with_suffix('')).replace(os.sep, '.')
+                    G.add_edge(imp_label, label)
         self._import_graph = G
         return G
 
@@ -894,13 +1369,16 @@ class LeanProject:
 
     def make_all(self) -> None:
         """Creates all.lean importing everything from the project"""
-
-        with (self.src_directory/'all.lean').open('w') as all_file:
-            for path in self.src_directory.glob('**/*.lean'):
-                rel = path.relative_to(self.src_directory).with_suffix('')
-                if rel == Path('all'):
-                    continue
-                all_file.write('import ' + ".".join(map(escape_identifier, rel.parts)) + '\n')
+        src_dir = str(self.src_directory)
+        lines = []
+        for entry in walk_files(self.src_directory, '.lean'):
+            parts = os.path.relpath(entry.path, src_dir)[:-len('.lean')].split(os.sep)
+            if parts == ['all']:
+                continue
+            lines.append('import ' + ".".join(map(escape_identifier, parts)) + '\n')
+        # sorted so that the file does not depend on the directory order
+        (self.src_directory/'all.lean').write_text(''.join(sorted(lines)),
+                                                   encoding='utf-8')
 
     def list_decls(self) -> Dict[str, DeclInfo]:
         """Collect declarations seen from this project, as a dictionary of
@@ -914,12 +1392,13 @@ class LeanProject:
 
         log.info('Gathering imports')
         self.make_all()
-        imports = (self.src_directory/'all.lean').read_text()
-        decls_lean = (Path(__file__).parent/'decls.lean').read_text()
-        list_decls_lean.write_text(imports+decls_lean)
+        imports = (self.src_directory/'all.lean').read_text(encoding='utf-8')
+        decls_lean = (Path(__file__).parent/'decls.lean').read_text(encoding='utf-8')
+        list_decls_lean.write_text(imports+decls_lean, encoding='utf-8')
         log.info('Collecting declarations')
         self.run_echo(['lean', '--run', str(list_decls_lean)])
-        data = yaml.safe_load((self.directory/'decls.yaml').open())
+        with (self.directory/'decls.yaml').open(encoding='utf-8') as decls_file:
+            data = read_decls(decls_file)
         list_decls_lean.unlink()
         if not all_exists:
             (self.src_directory/'all.lean').unlink()
@@ -941,7 +1420,7 @@ class LeanProject:
             else:
                 origin = self.name
                 path = path.relative_to(self.src_directory)
-            decls[name] = DeclInfo(origin, path, int(val['Line']))
+            decls[name] = DeclInfo(origin, path, int(line))
 
         return decls
 
@@ -1037,7 +1516,7 @@ class LeanProject:
                 map(snake_to_camel, leanfile.relative_to(mathlib4).with_suffix("").parts)).lower()
                 for leanfile in mathlib4.rglob("*") if leanfile.suffix == ".lean"}
 
-        port_status = PortStatus.deserialize_old()
+        port_status = PortStatus.deserialize_old(cache_dir=DOT_MATHLIB/'wiki-cache', url=url)
 
         for node_name, node in self.import_graph.nodes(data=True):
             node["status"] = port_status.file_statuses.get(node_name, FileStatus())
@@ -29,6 +29,6 @@ setuptools.setup(
         "Operating System :: OS Independent" ],
     python_requires='>=3.6',
     install_requires=['toml>=0.10.0', 'PyGithub', 'certifi', 'gitpython>=2.1.11', 'requests',
-                      'Click', 'tqdm', 'networkx', 'pydot',
+                      'Click', 'tqdm', 'networkx',
                       'PyYAML>=3.13', 'atomicwrites', "dataclasses; python_version=='3.6'"]
 )
@@ -0,0 +1,49 @@
+import requests
+
+from mathlibtools.file_status import FileStatus, PortStatus
+
+def test_parse_ported():
+    status = FileStatus.parse_old('Yes mathlib4#123 0123abcd')
+    assert status.ported
+    assert status.mathlib4_pr == 123
+    assert status.mathlib3_hash == '0123abcd'
+    assert status.comments is None
+
+def test_parse_pr():
+    status = FileStatus.parse_old('No: mathlib4#456 in review')
+    assert not status.ported
+    assert status.mathlib4_pr == 456
+    assert status.mathlib3_hash is None
+    assert status.comments == 'mathlib4#456 in review'
+
+def test_parse_comment():
+    status = FileStatus.parse_old('No: waiting on 2 files')
+    assert not status.ported
+    assert status.mathlib4_pr is None
+    assert status.comments == 'waiting on 2 files'
+
+def test_asdict():
+    assert FileStatus.parse_old('Yes mathlib4#123 0123abcd').asdict() == {
+        'ported': True, 'mathlib4_pr': 123, 'mathlib3_hash': '0123abcd'}
+
+def test_parse_no_hash():
+    status = FileStatus.parse_old('Yes mathlib4#123')
+    assert status.ported
+    assert status.mathlib4_pr == 123
+    assert status.mathlib3_hash is None
+
+def test_deserialize_old_cached(tmp_path, monkeypatch):
+    requests_made = []
+    class Response:
+        def __init__(self, headers):
+            requests_made.append(headers)
+            self.status_code = 304 if headers else 200
+            self.headers = {'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+            self.content = b"```\ndata.nat.basic: 'Yes mathlib4#123 abcdef'\n```\n"
+    monkeypatch.setattr(requests, 'get', lambda url, headers={}: Response(headers))
+    first = PortStatus.deserialize_old(cache_dir=tmp_path, url='https://example.com/status')
+    second = PortStatus.deserialize_old(cache_dir=tmp_path, url='https://example.com/status')
+    assert requests_made == [{}, {'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'}]
+    assert first == second
+    assert second.file_statuses['data.nat.basic'] == FileStatus(ported=True, mathlib4_pr=123,
+                                                                mathlib3_hash='abcdef')
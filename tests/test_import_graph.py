@@ -0,0 +1,101 @@
+from mathlibtools.import_graph import ImportGraph, _dot_quote
+from mathlibtools.file_status import FileStatus
+
+def make_graph(edges):
+    G = ImportGraph()
+    G.add_edges_from(edges)
+    return G
+
+def test_exclude_tactics():
+    G = make_graph([('logic.basic', 'tactic.foo'), ('tactic.foo', 'tactic.bar'),
+                    ('tactic.bar', 'data.nat'), ('tactic.core', 'data.nat'),
+                    ('logic.basic', 'data.list')])
+    H = G.exclude_tactics()
+    assert set(H.nodes) == {'logic.basic', 'tactic.core', 'data.nat', 'data.list'}
+    assert set(H.edges) == {('logic.basic', 'data.nat'), ('tactic.core', 'data.nat'),
+                            ('logic.basic', 'data.list')}
+    # the original graph is left untouched
+    assert 'tactic.foo' in G
+
+def test_path():
+    G = make_graph([('a', 'b'), ('b', 'c'), ('a', 'd'), ('x', 'b'), ('c', 'y')])
+    assert set(G.path('a', 'c').nodes) == {'a', 'b', 'c'}
+    assert set(G.path('a', 'a').nodes) == {'a'}
+    assert set(G.path('d', 'c').nodes) == set()
+
+def test_transitive_reduction():
+    G = make_graph([('a', 'b'), ('b', 'c'), ('a', 'c'), ('c', 'd'), ('a', 'd')])
+    G.nodes['a']['status'] = 'ported'
+    H = G.transitive_reduction()
+    assert set(H.edges) == {('a', 'b'), ('b', 'c'), ('c', 'd')}
+    assert H.nodes['a']['status'] == 'ported'
+
+def test_ancestors_cache_cleared():
+    G = make_graph([('a', 'b')])
+    assert set(G.ancestors('b')) == {'a', 'b'}
+    G.add_edge('c', 'b')
+    assert set(G.ancestors('b')) == {'a', 'b', 'c'}
+    G.remove_node('a')
+    assert set(G.ancestors('b')) == {'b', 'c'}
+
+def test_longest_path():
+    G = make_graph([('a', 'b'), ('b', 'c'), ('a', 'c'), ('d', 'c')])
+    assert G.longest_path() == ['a', 'b', 'c']
+    assert G.longest_path_length() == 2
+    assert ImportGraph().longest_path_length() == 0
+
+def test_delete_ported_children():
+    G = make_graph([('a', 'b'), ('b', 'c'), ('d', 'c'), ('tactic.e', 'c')])
+    for n, ported in [('a', True), ('b', True), ('c', False), ('d', True), ('tactic.e', False)]:
+        G.nodes[n]['status'] = FileStatus(ported=ported)
+    assert set(G.delete_ported_children(False).nodes) == {'b', 'c', 'd', 'tactic.e'}
+    assert set(G.delete_ported_children(True).nodes) == {'b', 'c', 'd'}
+
+def test_completely_ported():
+    G = make_graph([('a', 'b'), ('b', 'c'), ('d', 'c'), ('e', 'f'), ('c', 'all'),
+                    ('f', 'all')])
+    for n, ported in [('a', True), ('b', True), ('c', False), ('d', True),
+                      ('e', True), ('f', True)]:
+        G.nodes[n]['status'] = FileStatus(ported=ported)
+    assert set(G.completely_ported().nodes) == {'e', 'f'}
+
+def test_to_rawdot(tmp_path):
+    G = make_graph([('a.b', 'c')])
+    G.nodes['a.b']['label'] = 'say "hi"'
+    G.nodes['a.b']['fillcolor'] = None
+    G.to_rawdot(tmp_path/'graph.rawdot')
+    assert (tmp_path/'graph.rawdot').read_text() == (
+        'strict digraph {\n'
+        '"a.b" [label="say \\"hi\\""];\n'
+        '"c";\n'
+        '"a.b" -> "c";\n'
+        '}\n')
+
+def test_dot_quote():
+    assert _dot_quote('a') == '"a"'
+    assert _dot_quote('"a" and "b"') == '"\\"a\\" and \\"b\\""'
+    assert _dot_quote('a\\') == '"a\\\\"'
+
+def test_exclude_tactics_reduce():
+    G = make_graph([('a', 'tactic.foo'), ('tactic.foo', 'c'), ('a', 'b'), ('b', 'c'),
+                    ('a', 'c')])
+    H = G.exclude_tactics(reduce=True)
+    assert set(H.edges) == {('a', 'b'), ('b', 'c')}
+
+def test_memoized_reduction():
+    G = make_graph([('a', 'b'), ('b', 'c'), ('a', 'c')])
+    H = G.transitive_reduction()
+    assert G.transitive_reduction() is H
+    G.add_edge('c', 'd')
+    assert set(G.transitive_reduction().edges) == {('a', 'b'), ('b', 'c'), ('c', 'd')}
+
+def test_is_reduced():
+    G = make_graph([('a', 'b'), ('b', 'c'), ('a', 'c')])
+    assert not G.is_reduced
+    H = G.transitive_reduction()
+    assert H.is_reduced
+    assert H.transitive_reduction() is H
+    assert H.ancestors('b').is_reduced
+    assert G.exclude_tactics(reduce=True).is_reduced
+    H.add_edge('a', 'c')
+    assert not H.is_reduced
@@ -0,0 +1,270 @@
+import base64
+import hashlib
+import io
+import os
+import tarfile
+from types import SimpleNamespace
+
+import pytest
+
+import mathlibtools.lib
+from mathlibtools.lib import (InvalidLeanVersion, LeanProject, RemoteOleanCache, clean,
+                              delete_zombies, git_remote_exists, github_ssh_works,
+                              load_toml, oleans_up_to_date, pack, parse_version,
+                              read_decls, scan_oleans, touch_files, touch_oleans,
+                              unpack_archive)
+
+def test_oleans_up_to_date(tmp_path):
+    (tmp_path/'data').mkdir()
+    lean, olean = tmp_path/'data'/'nat.lean', tmp_path/'data'/'nat.olean'
+    lean.touch()
+    olean.touch()
+    os.utime(str(lean), (1, 1))
+    assert oleans_up_to_date(tmp_path)
+    os.utime(str(olean), (0, 0))
+    assert not oleans_up_to_date(tmp_path)
+    olean.unlink()
+    assert not oleans_up_to_date(tmp_path)
+    assert oleans_up_to_date(tmp_path/'missing')
+
+def test_touch_oleans(tmp_path):
+    (tmp_path/'data').mkdir()
+    olean = tmp_path/'data'/'nat.olean'
+    olean.touch()
+    os.utime(str(olean), (0, 0))
+    touch_oleans(tmp_path)
+    assert olean.stat().st_mtime > 0
+
+def test_scan_oleans(tmp_path):
+    (tmp_path/'data').mkdir()
+    lean, olean = tmp_path/'data'/'nat.lean', tmp_path/'data'/'nat.olean'
+    lean.touch()
+    olean.touch()
+    (tmp_path/'zombie.olean').touch()
+    os.utime(str(olean), (0, 0))
+    ok, oleans = scan_oleans(tmp_path)
+    assert not ok
+    assert sorted(oleans) == sorted([str(olean), str(tmp_path/'zombie.olean')])
+
+def test_github_ssh_works_cached(tmp_path, monkeypatch):
+    probes = []
+    def fake_probe(url):
+        probes.append(url)
+        return url.startswith('https')
+    monkeypatch.setattr(mathlibtools.lib, 'SSH_PROBE_FILE', tmp_path/'ssh')
+    monkeypatch.setattr(mathlibtools.lib, 'git_remote_exists', fake_probe)
+    assert not github_ssh_works('git@github.com:a/b.git', 'https://github.com/a/b.git')
+    assert len(probes) == 2
+    assert not github_ssh_works('git@github.com:a/b.git', 'https://github.com/a/b.git')
+    assert len(probes) == 2
+    os.utime(str(tmp_path/'ssh'), (0, 0))
+    monkeypatch.setattr(mathlibtools.lib, 'git_remote_exists', lambda url: True)
+    assert github_ssh_works('git@github.com:a/b.git', 'https://github.com/a/b.git')
+    assert (tmp_path/'ssh').read_text() == 'ok'
+
+def test_clone_retry_keeps_existing_directory(tmp_path, monkeypatch):
+    from git.exc import GitCommandError
+    attempts = []
+    def fake_clone_from(url, target, **kwargs):
+        attempts.append(target)
+        raise GitCommandError(['git', 'clone'], 128, stderr='Could not resolve host')
+    monkeypatch.setattr(mathlibtools.lib.Repo, 'clone_from', fake_clone_from)
+    monkeypatch.setattr(mathlibtools.lib, 'CLONE_RETRY_DELAYS', (0.01,))
+    (tmp_path/'proj').mkdir()
+    with pytest.raises(GitCommandError):
+        LeanProject.from_git_url('https://example.com/proj.git', str(tmp_path/'proj'))
+    assert len(attempts) == 2
+    assert (tmp_path/'proj').is_dir()
+
+def test_touch_files_many(tmp_path):
+    paths = [str(tmp_path/'{}.olean'.format(i)) for i in range(1000)]
+    for path in paths:
+        open(path, 'w').close()
+        os.utime(path, (0, 0))
+    touch_files(paths)
+    assert all(os.stat(path).st_mtime > 0 for path in paths)
+
+class FakeResponse:
+    def __init__(self, data, headers, status_code=200):
+        self.raw = io.BytesIO(data)
+        self.headers = headers
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+def test_remote_cache_download_parts(tmp_path, monkeypatch):
+    data = os.urandom(1000)
+    full_headers = {'content-length': str(len(data)), 'Accept-Ranges': 'bytes',
+                    'Content-MD5': base64.b64encode(hashlib.md5(data).digest()).decode()}
+    def fake_get(url, headers=None, stream=False):
+        if headers and 'Range' in headers:
+            start, end = headers['Range'][len('bytes='):].split('-')
+            return FakeResponse(data[int(start):int(end) + 1], {}, 206)
+        return FakeResponse(data, full_headers)
+    monkeypatch.setattr(mathlibtools.lib.HTTP_SESSION, 'get', fake_get)
+    monkeypatch.setattr(mathlibtools.lib.HTTP_SESSION, 'head',
+                        lambda url, allow_redirects=False: FakeResponse(b'', full_headers))
+    monkeypatch.setattr(mathlibtools.lib, 'short_sha', lambda rev: 'abc')
+    monkeypatch.setattr(mathlibtools.lib, 'PARALLEL_DOWNLOAD_MIN_SIZE', 100)
+    locator = SimpleNamespace(cache_url='https://example.com/', cache_dir=tmp_path)
+    rev = SimpleNamespace(hexsha='abc')
+    local = RemoteOleanCache(locator, rev).make_local()
+    assert local.path.read_bytes() == data
+    # a small cache is downloaded in a single request, only started then
+    monkeypatch.setattr(mathlibtools.lib, 'PARALLEL_DOWNLOAD_MIN_SIZE', 10000)
+    local.path.unlink()
+    cache = RemoteOleanCache(locator, rev)
+    assert cache.req is None
+    assert cache.make_local().path.read_bytes() == data
+
+def test_remote_cache_unpack_is_atomic(tmp_path, monkeypatch):
+    (tmp_path/'src').mkdir()
+    (tmp_path/'src'/'a.olean').write_text('new')
+    archive = tmp_path/'cache.tar.xz'
+    with tarfile.open(str(archive), 'w:xz') as tar:
+        tar.add(str(tmp_path/'src'), arcname='src')
+    data = archive.read_bytes()
+    served = [data[:len(data) // 2], data]
+    monkeypatch.setattr(mathlibtools.lib.HTTP_SESSION, 'get',
+                        lambda url, stream=False: FakeResponse(served.pop(0), {}))
+    monkeypatch.setattr(mathlibtools.lib.HTTP_SESSION, 'head',
+                        lambda url, allow_redirects=False: FakeResponse(b'', {}))
+    monkeypatch.setattr(mathlibtools.lib, 'short_sha', lambda rev: 'abc')
+    (tmp_path/'cache').mkdir()
+    (tmp_path/'project'/'src').mkdir(parents=True)
+    (tmp_path/'project'/'src'/'a.olean').write_text('old')
+    locator = SimpleNamespace(cache_url='https://example.com/', cache_dir=tmp_path/'cache')
+    rev = SimpleNamespace(hexsha='abc')
+    with pytest.raises(Exception):
+        RemoteOleanCache(locator, rev).unpack(tmp_path/'project', oleans_only=True)
+    assert (tmp_path/'project'/'src'/'a.olean').read_text() == 'old'
+    assert sorted(os.listdir(str(tmp_path))) == ['cache', 'cache.tar.xz', 'project', 'src']
+    RemoteOleanCache(locator, rev).unpack(tmp_path/'project', oleans_only=True)
+    assert (tmp_path/'project'/'src'/'a.olean').read_text() == 'new'
+    assert sorted(os.listdir(str(tmp_path))) == ['cache', 'cache.tar.xz', 'project', 'src']
+
+def test_remote_cache_unpack_bad_md5(tmp_path, monkeypatch):
+    (tmp_path/'src').mkdir()
+    (tmp_path/'src'/'a.olean').write_text('new')
+    archive = tmp_path/'cache.tar.xz'
+    with tarfile.open(str(archive), 'w:xz') as tar:
+        tar.add(str(tmp_path/'src'), arcname='src')
+    headers = {'Content-MD5': base64.b64encode(hashlib.md5(b'other').digest()).decode()}
+    monkeypatch.setattr(mathlibtools.lib.HTTP_SESSION, 'get',
+                        lambda url, stream=False: FakeResponse(archive.read_bytes(), headers))
+    monkeypatch.setattr(mathlibtools.lib.HTTP_SESSION, 'head',
+                        lambda url, allow_redirects=False: FakeResponse(b'', headers))
+    monkeypatch.setattr(mathlibtools.lib, 'short_sha', lambda rev: 'abc')
+    (tmp_path/'cache').mkdir()
+    locator = SimpleNamespace(cache_url='https://example.com/', cache_dir=tmp_path/'cache')
+    rev = SimpleNamespace(hexsha='abc')
+    with pytest.raises(mathlibtools.lib.LeanDownloadError):
+        RemoteOleanCache(locator, rev).unpack(tmp_path/'out', oleans_only=True)
+    assert not (tmp_path/'out'/'src'/'a.olean').exists()
+    assert not (tmp_path/'cache'/'abc.tar.xz').exists()
+
+def test_unpack_archive_stream(tmp_path):
+    (tmp_path/'src').mkdir()
+    (tmp_path/'src'/'nat.olean').write_text('olean')
+    (tmp_path/'src'/'nat.lean').write_text('lean')
+    archive = tmp_path/'cache.tar.xz'
+    with tarfile.open(str(archive), 'w:xz') as tar:
+        tar.add(str(tmp_path/'src'), arcname='src')
+    with archive.open('rb') as src:
+        unpack_archive(src, tmp_path/'out', oleans_only=True, xz=True)
+    assert (tmp_path/'out'/'src'/'nat.olean').read_text() == 'olean'
+    assert not (tmp_path/'out'/'src'/'nat.lean').exists()
+
+def test_pack(tmp_path):
+    (tmp_path/'src').mkdir()
+    (tmp_path/'src'/'nat.olean').write_text('olean')
+    pack(tmp_path, [tmp_path/'src'], tmp_path/'cache.tar.xz')
+    with tarfile.open(str(tmp_path/'cache.tar.xz')) as tar:
+        assert sorted(tar.getnames()) == ['src', 'src/nat.olean']
+
+def test_pack_failure_keeps_target(tmp_path):
+    (tmp_path/'src').mkdir()
+    (tmp_path/'src'/'nat.olean').write_text('olean')
+    (tmp_path/'cache.tar.xz').write_text('previous')
+    with pytest.raises(FileNotFoundError):
+        pack(tmp_path, [tmp_path/'src', tmp_path/'missing'], tmp_path/'cache.tar.xz')
+    assert (tmp_path/'cache.tar.xz').read_text() == 'previous'
+    assert sorted(os.listdir(str(tmp_path))) == ['cache.tar.xz', 'src']
+
+def test_load_toml(tmp_path):
+    path = tmp_path/'leanpkg.toml'
+    path.write_text('[package]\nname = "foo"\n')
+    config = load_toml(path)
+    assert config == {'package': {'name': 'foo'}}
+    config['package']['name'] = 'bar'
+    assert load_toml(path)['package']['name'] == 'foo'
+    path.write_text('[package]\nname = "quux"\n')
+    os.utime(str(path), ns=(0, 1))
+    assert load_toml(path)['package']['name'] == 'quux'
+
+def test_clean_and_delete_zombies(tmp_path):
+    (tmp_path/'data').mkdir()
+    for name in ['nat.lean', 'nat.olean', 'zombie.olean', 'data/int.olean']:
+        (tmp_path/name).touch()
+    delete_zombies(tmp_path)
+    assert (tmp_path/'nat.olean').exists()
+    assert not (tmp_path/'zombie.olean').exists()
+    assert not (tmp_path/'data'/'int.olean').exists()
+    clean(tmp_path)
+    assert not (tmp_path/'nat.olean').exists()
+    assert (tmp_path/'nat.lean').exists()
+
+def test_read_decls():
+    lines = ['"nat.add_comm":\n',
+             '  File: /src/init/data/nat/lemmas.olean\n',
+             '  Line: 42\n',
+             '"foo.«bar baz»":\n',
+             '  File: \n',
+             '  Line: \n']
+    assert read_decls(lines) == {
+        'nat.add_comm': {'File': '/src/init/data/nat/lemmas.olean', 'Line': '42'},
+        'foo.«bar baz»': {'File': None, 'Line': None}}
+
+def test_parse_version():
+    assert parse_version('leanprover-community/lean:3.50.3') == (3, 50, 3)
+    assert parse_version('lean-3.4.2') == (3, 4, 2)
+    assert parse_version('Lean (version 3.4.2, commit cbd2b6686ddb, Release)') == (3, 4, 2)
+    assert parse_version('3.5.1') == (3, 5, 1)
+    with pytest.raises(InvalidLeanVersion):
+        parse_version('leanprover/lean:nightly')
+
+def test_git_remote_exists_never_prompts(monkeypatch):
+    calls = []
+    def fake_run(args, **kwargs):
+        calls.append((args, kwargs))
+        return SimpleNamespace(returncode=0, stdout='')
+    monkeypatch.setattr(mathlibtools.lib.subprocess, 'run', fake_run)
+    monkeypatch.delenv('GIT_SSH_COMMAND', raising=False)
+    monkeypatch.delenv('GIT_SSH', raising=False)
+    assert git_remote_exists('git@github.com:a/b.git')
+    args, kwargs = calls[-1]
+    assert args[:2] == ['git', 'ls-remote']
+    assert kwargs['env']['GIT_TERMINAL_PROMPT'] == '0'
+    assert 'BatchMode=yes' in kwargs['env']['GIT_SSH_COMMAND']
+    assert 'ConnectTimeout=' in kwargs['env']['GIT_SSH_COMMAND']
+    # a user-provided ssh command is left alone
+    monkeypatch.setenv('GIT_SSH_COMMAND', 'ssh -i mykey')
+    git_remote_exists('git@github.com:a/b.git')
+    assert calls[-1][1]['env']['GIT_SSH_COMMAND'] == 'ssh -i mykey'
+    monkeypatch.delenv('GIT_SSH_COMMAND')
+    def fake_run_configured(args, **kwargs):
+        calls.append((args, kwargs))
+        return SimpleNamespace(returncode=0, stdout='ssh -i otherkey\n')
+    monkeypatch.setattr(mathlibtools.lib.subprocess, 'run', fake_run_configured)
+    git_remote_exists('git@github.com:a/b.git')
+    assert 'GIT_SSH_COMMAND' not in calls[-1][1]['env']
@@ -1,3 +1,6 @@
+import click
+import pytest
+
 from mathlibtools.leanproject import parse_project_name as P
 
 def test_name():
@@ -55,3 +58,19 @@ def test_ssh_branch():
     assert url == 'git@github.com:leanprover-community/tutorials.git'
     assert branch == 'foo'
     assert is_url
+
+def test_invalid():
+    with pytest.raises(click.BadParameter):
+        P('tutorials:foo:bar')
+
+def test_too_many_slashes():
+    with pytest.raises(click.BadParameter):
+        P('a/b/c')
+    with pytest.raises(click.BadParameter):
+        P('leanprover-community/tutorials/extra/path:foo')
+
+def test_http_prefixed_name():
+    name, url, branch, is_url = P('httpfoo')
+    assert name == 'httpfoo'
+    assert not is_url
+    assert url.endswith('leanprover-community/httpfoo.git')